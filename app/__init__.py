@@ -1,22 +1,105 @@
 """Docstring: __init__ point of the application.
 This is where the application is initialized and the Flask app is created."""
 
+import os
 import shutil
+import time
+from threading import Lock, Thread
 from flask import Flask
 from app.data_ingestor import DataIngestor
 from app.data_parser import DataParser
 from app.task_runner import ThreadPool
 
+START_TIME = time.perf_counter()
+
+# Dataset served by the application, keeping only the columns used by the parser with the
+# strings stored as categoricals. The csv is converted once to a binary snapshot next to it
+# (or in DATASET_SNAPSHOT, empty to disable) that every worker memory-maps, sharing one
+# physical copy of the data and skipping the csv parsing on the next boots. With
+# DATASET_CHUNK_SIZE set, the csv is streamed in chunks of that many rows and only the
+# sums and counts of the data values are kept, for datasets that do not fit in memory
+CSV_PATH = "nutrition_activity_obesity_usa_subset.csv"
+DATASET = {
+    "csv_path": CSV_PATH,
+    "compact": True,
+    "snapshot_path": os.environ.get('DATASET_SNAPSHOT', f"{CSV_PATH}.snapshot"),
+    "chunk_size": int(os.environ.get('DATASET_CHUNK_SIZE', 0)) or None
+}
+
+# The admin routes can only load csv files from this directory (DATASET_DIR, the directory
+# of the dataset by default), and only for requests with the ADMIN_TOKEN in their
+# X-Admin-Token header. Without ADMIN_TOKEN the admin routes are disabled
+DATASET_DIR = os.environ.get('DATASET_DIR', os.path.dirname(os.path.abspath(CSV_PATH)))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
 WEB_SERVER = Flask(__name__)
-WEB_SERVER.tasks_runner = ThreadPool()
+
+# With TP_BACKEND=process every worker process loads the dataset once, when it starts
+WEB_SERVER.tasks_runner = ThreadPool(dataset=DATASET)
 
 # Delete /results directory if it exists and create a new one
 shutil.rmtree('results', ignore_errors=True)
 
-# Read the csv path from nutrition_activity_obesity_usa_subset.csv
-WEB_SERVER.data_ingestor = DataIngestor("nutrition_activity_obesity_usa_subset.csv")
-WEB_SERVER.data_parser = DataParser(WEB_SERVER.data_ingestor)
-WEB_SERVER.job_counter = 1
+# The dataset is loaded in the background, the server is ready once data_parser is set
+WEB_SERVER.data_ingestor = None
+WEB_SERVER.data_parser = None
+WEB_SERVER.init_error = None
 WEB_SERVER.is_shutdown = False
 
+# Set while a new dataset is loaded, so only one reload runs at a time
+WEB_SERVER.reload_lock = Lock()
+WEB_SERVER.is_reloading = False
+
+def load_dataset(dataset, previous=None):
+    """Load the dataset and build the parser with its index and summaries. The jobs and
+    results of the previous parser are kept, so no job is lost when the dataset changes"""
+    data_ingestor = DataIngestor(**dataset)
+    if previous is None:
+        data_parser = DataParser(data_ingestor)
+    else:
+        data_parser = DataParser(data_ingestor, previous.job_maintainer, previous.results)
+    data_parser.index.warm_up()
+
+    return data_ingestor, data_parser
+
+def initialize():
+    """Load the dataset and build the parser with its index in the background"""
+    try:
+        # Read the csv path from nutrition_activity_obesity_usa_subset.csv
+        data_ingestor, data_parser = load_dataset(DATASET)
+    except Exception as exception:  # pylint: disable=broad-exception-caught
+        # Any failure is reported by the routes, the server would otherwise stay loading
+        WEB_SERVER.init_error = f"{type(exception).__name__}: {exception}"
+        return
+
+    # Publish the parser last, routes check it to know if the server is ready
+    WEB_SERVER.data_ingestor = data_ingestor
+    WEB_SERVER.data_parser = data_parser
+
+    data_parser.logger.info("Loaded the dataset from the %s in %.3f s, ready in %.3f s",
+                            data_ingestor.source, data_ingestor.load_time,
+                            time.perf_counter() - START_TIME)
+
+def reload_dataset(dataset):
+    """Load a new dataset in the background and swap it in once it is ready. The jobs already
+    submitted finish against the old dataset. The caller sets is_reloading"""
+    try:
+        start = time.perf_counter()
+        data_ingestor, data_parser = load_dataset(dataset, WEB_SERVER.data_parser)
+        WEB_SERVER.tasks_runner.reload(dataset)
+
+        # Swap the parser in a single assignment, new requests use the new dataset
+        WEB_SERVER.data_ingestor = data_ingestor
+        WEB_SERVER.data_parser = data_parser
+
+        data_parser.logger.info("Reloaded the dataset from %s in %.3f s",
+                                dataset['csv_path'], time.perf_counter() - start)
+    except (OSError, ValueError) as exception:
+        WEB_SERVER.data_parser.logger.error("Reloading the dataset from %s failed: %s",
+                                            dataset['csv_path'], exception)
+    finally:
+        WEB_SERVER.is_reloading = False
+
+Thread(target=initialize, name='initializer', daemon=True).start()
+
 from app import routes
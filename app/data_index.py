@@ -0,0 +1,257 @@
+"""This module builds an aggregate index over the data so that the parser does not have to
+rescan the whole dataframe for every request"""
+from collections import namedtuple
+from threading import Lock
+import numpy as np
+import pandas as pd
+from app.result_cache import ResultCache
+
+# Interval of years taken into account by the endpoints when the request does not set one
+YEAR_START = 2011
+YEAR_END = 2022
+
+# Columns the means are grouped by, besides the question
+GROUP_COLUMNS = ['LocationDesc', 'StratificationCategory1', 'Stratification1']
+
+# Columns the aggregates of a question are sorted by, so a year window is a slice of them
+INDEX_COLUMNS = ['YearStart', 'YearEnd'] + GROUP_COLUMNS
+
+# Rows selected by a request: the year window and optionally a single stratification
+QueryFilter = namedtuple('QueryFilter',
+                         ['year_start', 'year_end', 'stratification_category', 'stratification'])
+DEFAULT_FILTER = QueryFilter(YEAR_START, YEAR_END, None, None)
+
+# Number of indexes of filtered questions kept, the least recently used are dropped
+FILTER_CACHE_SIZE = 256
+
+def _mean(total, count):
+    """Divide total by count, returning NaN for an empty group like pandas does"""
+    if count == 0:
+        return np.nan
+    return total / count
+
+class StateSummary:
+    """Per-state means and global mean of a question, shared by the per-state endpoints"""
+    def __init__(self, states_mean: pd.DataFrame, global_mean):
+        """Initialize the summary from the means of the states, ordered by state"""
+        self.global_mean = global_mean
+        self.by_state = states_mean
+        self.means = dict(zip(states_mean['LocationDesc'], states_mean['Data_Value']))
+
+        # Both orders are kept so the rankings are a simple head of a sorted frame
+        self.ranked = {
+            True: states_mean.sort_values('Data_Value', ascending=True),
+            False: states_mean.sort_values('Data_Value', ascending=False)
+        }
+
+    def sorted_by_mean(self, ascending):
+        """Return the means of the states ordered by mean"""
+        return self.ranked[ascending].copy()
+
+    def head(self, ascending, count=5):
+        """Return the first count states ordered by mean"""
+        return self.ranked[ascending].head(count).copy()
+
+    def state_mean(self, state):
+        """Return the mean of the given state, NaN if the state has no data values"""
+        return self.means.get(state, np.nan)
+
+    def diff_from_mean(self):
+        """Return the difference between the global mean and the mean of each state"""
+        data_diff = self.by_state.copy()
+        data_diff['Data_Value'] = self.global_mean - data_diff['Data_Value']
+        return data_diff
+
+    def state_diff_from_mean(self, state):
+        """Return the difference between the global mean and the mean of the given state"""
+        return self.global_mean - self.state_mean(state)
+
+class QuestionIndex:
+    """Sums and counts of the data values for a single question in the interval 2011-2022"""
+    def __init__(self, aggregates: pd.DataFrame):
+        """Initialize the index from sums and counts grouped by state and stratification"""
+        # Sums and counts for each (state, category, stratification)
+        self.categories = aggregates
+
+        # Sums and counts for each state, over all its stratifications
+        self.states = (
+            aggregates
+            .groupby(level='LocationDesc', observed=True)[['sum', 'count']]
+            .sum()
+        )
+
+        # Sum and count of all the data values of the question
+        self.total_sum = aggregates['sum'].sum()
+        self.total_count = aggregates['count'].sum()
+
+        # Summary of the states, computed on first use and shared by all the requests
+        self.summary_lock = Lock()
+        self.state_summary = None
+
+    def summary(self):
+        """Return the per-state summary of the question, computing it only once"""
+        if self.state_summary is None:
+            # Concurrent requests for the same question wait for a single computation
+            with self.summary_lock:
+                if self.state_summary is None:
+                    self.state_summary = StateSummary(self.states_mean(), self.global_mean())
+
+        return self.state_summary
+
+    def global_mean(self):
+        """Return the mean of all the data values of the question"""
+        return _mean(self.total_sum, self.total_count)
+
+    def states_mean(self):
+        """Return the mean of the data values for each state, ordered by state"""
+        return pd.DataFrame({
+            'LocationDesc': self.states.index.to_numpy(),
+            'Data_Value': (self.states['sum'] / self.states['count']).to_numpy()
+        })
+
+    def categories_mean(self):
+        """Return the mean of the data values for each state, category and stratification"""
+        data_mean = self.categories.reset_index().dropna(subset=GROUP_COLUMNS)
+        data_mean['Data_Value'] = data_mean['sum'] / data_mean['count']
+        return data_mean[GROUP_COLUMNS + ['Data_Value']].reset_index(drop=True)
+
+    def state_categories_mean(self, state):
+        """Return the mean of the data values for each category and stratification of a state"""
+        data_mean = self.categories_mean()
+        data_mean = data_mean[data_mean['LocationDesc'] == state]
+        return data_mean[GROUP_COLUMNS[1:] + ['Data_Value']].reset_index(drop=True)
+
+def parse_filter(data):
+    """Read the optional year_start, year_end, stratification_category and stratification
+    fields of a request, raising ValueError if they are invalid"""
+    if not isinstance(data, dict):
+        raise ValueError("Invalid request")
+
+    years = []
+    for field, default in (('year_start', YEAR_START), ('year_end', YEAR_END)):
+        year = data.get(field, default)
+        if not isinstance(year, int) or isinstance(year, bool):
+            raise ValueError(f"Invalid {field}")
+        years.append(year)
+    if years[0] > years[1]:
+        raise ValueError("Invalid year window")
+
+    for field in ('stratification_category', 'stratification'):
+        if not isinstance(data.get(field, ''), str):
+            raise ValueError(f"Invalid {field}")
+
+    return QueryFilter(years[0], years[1], data.get('stratification_category'),
+                       data.get('stratification'))
+
+def aggregate(data: pd.DataFrame):
+    """Compute the sums and counts of the data values grouped by question, years, state and
+    stratification"""
+    # Keep only the rows that have a data value, every year is kept for the filters
+    data_filtered = data.dropna(subset=['Data_Value'])
+
+    # Rows without a stratification still count towards the state and global means
+    return (
+        data_filtered
+        .groupby(['Question'] + INDEX_COLUMNS, dropna=False, observed=True)['Data_Value']
+        .agg(['sum', 'count'])
+    )
+
+def merge_aggregates(tables):
+    """Add up the sums and counts of several aggregate tables with the same index levels"""
+    return (
+        pd.concat(tables)
+        .groupby(level=list(tables[0].index.names), dropna=False, observed=True)
+        .sum()
+    )
+
+def select(table: pd.DataFrame, query_filter: QueryFilter):
+    """Sum over the years the sums and counts of a question that match the filter"""
+    # The table is sorted by YearStart, so the window is found by binary search
+    rows = table.loc[query_filter.year_start:query_filter.year_end]
+    mask = rows.index.get_level_values('YearEnd') <= query_filter.year_end
+    if query_filter.stratification_category is not None:
+        mask &= (rows.index.get_level_values('StratificationCategory1')
+                 == query_filter.stratification_category)
+    if query_filter.stratification is not None:
+        mask &= rows.index.get_level_values('Stratification1') == query_filter.stratification
+
+    return rows[mask].groupby(level=GROUP_COLUMNS, dropna=False, observed=True).sum()
+
+class DataIndex:
+    """Per-question index of the sums and counts of the data values, built once"""
+    def __init__(self, data: pd.DataFrame, aggregates: pd.DataFrame = None):
+        """Build the index from the data in a single pass over the rows, or from the sums and
+        counts already aggregated from them"""
+        # Sums and counts of each question for every year, and the index of the default window
+        self.tables = {}
+        self.questions = {}
+        self.lock = Lock()
+
+        # Indexes of the questions for the other filters, built on first use
+        self.filtered = ResultCache(FILTER_CACHE_SIZE)
+
+        if aggregates is None:
+            aggregates = aggregate(data)
+        self.empty = QuestionIndex(aggregates.iloc[0:0].droplevel(['Question', 'YearStart',
+                                                                   'YearEnd']))
+
+        for question, group in aggregates.groupby(level='Question', observed=True):
+            self.add_question(question, group.droplevel('Question').sort_index())
+
+    def add_question(self, question, table: pd.DataFrame):
+        """Set the sums and counts of a question and build the index of the default window"""
+        self.tables[question] = table
+
+        # Questions without data values in the default window are left out, as unknown ones
+        selected = select(table, DEFAULT_FILTER)
+        if len(selected) > 0:
+            self.questions[question] = QuestionIndex(selected)
+        else:
+            self.questions.pop(question, None)
+
+    def append(self, data: pd.DataFrame):
+        """Add the sums and counts of new rows to the index of their questions"""
+        aggregates = aggregate(data)
+
+        with self.lock:
+            for question, group in aggregates.groupby(level='Question', observed=True):
+                group = group.droplevel('Question')
+
+                # Add the new sums and counts to the ones of the question
+                if question in self.tables:
+                    group = merge_aggregates([self.tables[question], group])
+
+                # Replace the index of the question in one assignment, its summary is rebuilt
+                self.add_question(question, group.sort_index())
+
+            # The indexes of the filtered questions may be out of date
+            self.filtered.clear()
+
+    def warm_up(self):
+        """Compute the summary of every question before the index serves requests"""
+        for question_index in self.questions.values():
+            question_index.summary()
+
+    def has_question(self, question):
+        """Check if the given question has any data values in the index"""
+        return question in self.questions
+
+    def get(self, question, query_filter: QueryFilter = DEFAULT_FILTER):
+        """Return the index of the given question restricted to the filter, empty if the
+        question is unknown"""
+        if query_filter == DEFAULT_FILTER:
+            return self.questions.get(question, self.empty)
+
+        table = self.tables.get(question)
+        if table is None:
+            return self.empty
+
+        # Reuse the index of the filter unless the question was appended to since
+        key = (question, query_filter)
+        cached = self.filtered.get(key)
+        if cached is not None and cached[0] is table:
+            return cached[1]
+
+        question_index = QuestionIndex(select(table, query_filter))
+        self.filtered.put(key, (table, question_index))
+        return question_index
@@ -1,12 +1,76 @@
 """This module is responsible for reading the csv file and returning the data as a
 pandas dataframe"""
-import os
+import time
+from threading import Lock
 import pandas as pd
+from pandas.api.types import union_categoricals
+from app.data_index import aggregate, merge_aggregates
+from app.data_snapshot import is_snapshot_valid, load_snapshot, try_load_snapshot, write_snapshot
+
+# Columns used by the parser, the only ones kept when loading in compact mode
+PARSER_COLUMNS = ['YearStart', 'YearEnd', 'LocationDesc', 'Question', 'Data_Value',
+                  'StratificationCategory1', 'Stratification1']
+
+# String columns stored as categoricals in compact mode
+CATEGORY_COLUMNS = ['LocationDesc', 'Question', 'StratificationCategory1', 'Stratification1']
+
+# Numeric columns downcast to the smallest integer type in compact mode
+INTEGER_COLUMNS = ['YearStart', 'YearEnd']
+
+def read_csv(csv_path: str, compact: bool = False):
+    """Read the csv file, keeping only the parser columns in compact dtypes if requested"""
+    if not compact:
+        return pd.read_csv(csv_path)
+
+    # Load the strings as categoricals so filters compare integer codes
+    data = pd.read_csv(csv_path, usecols=PARSER_COLUMNS,
+                       dtype={column: 'category' for column in CATEGORY_COLUMNS})
+    for column in INTEGER_COLUMNS:
+        data[column] = pd.to_numeric(data[column], downcast='integer')
+
+    return data
+
+def read_aggregates(csv_path: str, chunk_size: int):
+    """Read the csv file in chunks of chunk_size rows, folding each chunk into the sums and
+    counts of the data values, so at most one chunk of rows is in memory at a time"""
+    aggregates = None
+    chunks = pd.read_csv(csv_path, usecols=PARSER_COLUMNS, chunksize=chunk_size,
+                         dtype={column: 'category' for column in CATEGORY_COLUMNS})
+
+    with chunks:
+        for chunk in chunks:
+            chunk_aggregates = aggregate(chunk)
+            if aggregates is None:
+                aggregates = chunk_aggregates
+            else:
+                aggregates = merge_aggregates([aggregates, chunk_aggregates])
+
+    if aggregates is None:
+        raise ValueError(f"No rows to read from {csv_path}")
+    return aggregates
+
+def concat_data(data: pd.DataFrame, rows: pd.DataFrame):
+    """Append the rows to the data, keeping the categorical columns categorical"""
+    columns = {}
+    for column in data.columns:
+        if isinstance(data[column].dtype, pd.CategoricalDtype):
+            # Give the new values the type of the categories, an empty column is read as floats
+            categories = data[column].cat.categories
+            new_values = rows[column].astype(categories.dtype).astype('category')
+            columns[column] = union_categoricals([data[column], new_values], ignore_order=True)
+        else:
+            columns[column] = pd.concat([data[column], rows[column]], ignore_index=True)
+
+    return pd.DataFrame(columns)
 
 class DataIngestor:
     """This class reads the csv file and returns the data as a pandas dataframe"""
-    def __init__(self, csv_path: str):
-        """Read the csv file and return the data as a pandas dataframe"""
+    def __init__(self, csv_path: str, compact: bool = False, snapshot_path: str = None,
+                 chunk_size: int = None):
+        """Read the csv file and return the data as a pandas dataframe. With a snapshot_path
+        the csv is converted to a binary snapshot that is memory-mapped read-only, and the
+        snapshot is reused as long as the csv does not change. With a chunk_size the csv is
+        streamed in chunks and only the sums and counts of the data values are kept"""
         # The csv has the following columns:
         # YearStart,YearEnd, LocationAbbr, LocationDesc, Datasource, Class, Topic, Question,
         # Data_Value_Unit,Data_Value_Type,Data_Value,
@@ -15,21 +79,73 @@ class DataIngestor:
         # Age(years), Education, Gender, Income, Race/Ethnicity, GeoLocation, ClassID, TopicID,
         # QuestionID, DataValueTypeID, LocationID,
         # StratificationCategory1, Stratification1, StratificationCategoryId1, StratificationID1
-        # Create the results directory if it does not exist
-        if not os.path.exists('results'):
-            os.makedirs('results')
 
-        if csv_path:
-            self.data = pd.read_csv(csv_path)
+        # In compact mode only the parser columns are kept, with strings as categoricals
+        self.compact = compact
+
+        # Where the data was loaded from and how long it took, reported at startup
+        self.source = None
+        self.load_time = 0.0
+        self.lock = Lock()
+        start = time.perf_counter()
+
+        # Sums and counts of the data values, set only when the rows are not kept
+        self.aggregates = None
+
+        if chunk_size:
+            # Streaming mode, the memory used is bounded by the size of a chunk
+            self.source = 'stream'
+            self.data = None
+            self.aggregates = read_aggregates(csv_path, chunk_size)
+        elif snapshot_path:
+            # Convert the csv only if the snapshot is missing, damaged or was made from another
+            # csv, a damaged snapshot is replaced by the new one
+            self.source = 'snapshot'
+            self.data = None
+            if is_snapshot_valid(snapshot_path, csv_path):
+                self.data = try_load_snapshot(snapshot_path)
+            if self.data is None or not set(PARSER_COLUMNS) <= set(self.data.columns):
+                self.source = 'csv'
+                write_snapshot(read_csv(csv_path, compact=True), snapshot_path, csv_path)
+                self.data = load_snapshot(snapshot_path)
+        elif csv_path:
+            self.source = 'csv'
+            self.data = read_csv(csv_path, compact)
         else:
             self.data = None
 
+        self.load_time = time.perf_counter() - start
+
     def read_test_csv(self, csv_path: str):
         """Read the csv file and return the data as a pandas dataframe"""
-        self.data = pd.read_csv(csv_path)
+        self.data = read_csv(csv_path, self.compact)
         return self.data
 
     def get(self):
         """Return the data"""
         return self.data
- 
\ No newline at end of file
+
+    def append_csv(self, csv_source):
+        """Read new rows from a csv file or buffer, check them against the schema of the data
+        and append them. Return the new rows"""
+        rows = read_csv(csv_source, self.compact or self.source != 'csv')
+        if rows.empty:
+            raise ValueError("No rows to append")
+
+        # The new rows must have the columns of the data, with numeric years and values
+        columns = PARSER_COLUMNS if self.data is None else list(self.data.columns)
+        missing = set(columns) - set(rows.columns)
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+        for column in INTEGER_COLUMNS + ['Data_Value']:
+            rows[column] = pd.to_numeric(rows[column], errors='raise')
+        rows = rows[columns]
+
+        # In streaming mode the rows only go to the index of the parser
+        if self.data is None:
+            return rows
+
+        with self.lock:
+            self.data = concat_data(self.data, rows)
+
+        return rows
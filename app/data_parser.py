@@ -1,73 +1,206 @@
 """This module is responsible for parsing the data and returning the results as a JSON file"""
+import functools
 import json
+import os
+import time
 import pandas as pd
-from app.job_maintainer import JobMaintainer
+from app.job_maintainer import JobMaintainer, JobRetention
 from app.data_ingestor import DataIngestor
+from app.data_index import DataIndex, parse_filter
 from app.logger import Logger
-
-def json_writer(data, job_id):
-    """Write the data as a JSON file with the name of the job_id as the filename"""
+from app.metrics import METRICS, timed
+from app.result_cache import ResultCache, make_key
+from app.result_store import ResultStore
+
+# orjson is an optional, faster encoder of the job results
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encoder of the job results, json by default. With RESULT_JSON_ENCODER=orjson and orjson
+# installed the results are encoded by orjson, which writes NaN as null
+JSON_ENCODER = os.environ.get('RESULT_JSON_ENCODER', 'json')
+
+def encode(data):
+    """Serialize the data to JSON bytes with the configured encoder"""
+    if JSON_ENCODER == 'orjson' and orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    return json.dumps(data).encode()
+
+def done_envelope(payload: bytes):
+    """Wrap the serialized data of a job in the response sent once the job is done"""
+    return b'{"status": "done", "data": ' + payload + b'}'
+
+def error_envelope(reason: str):
+    """Serialize the response sent for a job that failed"""
+    return json.dumps({"status": "error", "reason": reason}).encode()
+
+def dict_writer(store, data_dict, job_id):
+    """Serialize the dictionary in the response of a finished job, store it as the result of
+    the job and return it"""
+    # Write field:value pairs in json format, ready to be sent as they are
+    start = time.perf_counter()
+    result = done_envelope(encode(data_dict))
+    serialized = time.perf_counter()
+    store.put(job_id, result)
+
+    METRICS.observe('job_stage_seconds', serialized - start, stage='serialize')
+    METRICS.observe('job_stage_seconds', time.perf_counter() - serialized, stage='write')
+    return result
+
+def json_writer(store, data, job_id):
+    """Store the data as JSON under the job_id in the result store"""
     # Use zip to create a dictionary with the structure {state: mean}
     data_dict = dict(zip(data['LocationDesc'], data['Data_Value']))
 
-    # Save the results in results/ directory with the name of the job_id as json file
-    with open(f'results/{job_id}.json', 'w', encoding="utf-8") as file:
-        # Write field:value pairs in json format
-        json.dump(data_dict, file)
+    return dict_writer(store, data_dict, job_id)
+
+def category_dict(data, columns):
+    """Build a dictionary with the structure {"('col1', 'col2', ...)": mean} from the data,
+    formatting the keys column by column instead of row by row"""
+    keys = "('" + data[columns[0]].astype(str)
+    for column in columns[1:]:
+        keys = keys + "', '" + data[column].astype(str)
+    keys = keys + "')"
+
+    return dict(zip(keys.tolist(), data['Data_Value'].tolist()))
+
+def to_result_dict(endpoint, data, result):
+    """Convert the result of a direct call of an endpoint to the dictionary its job returns"""
+    if endpoint in ('mean_by_category', 'state_mean_by_category'):
+        return result
+    if endpoint == 'global_mean':
+        return {"global_mean": result['Data_Value'].values[0]}
+    if endpoint == 'state_diff_from_mean':
+        return {data['state']: result}
+
+    # Use zip to create a dictionary with the structure {state: mean}
+    return dict(zip(result['LocationDesc'], result['Data_Value']))
+
+def invalid_filter(data):
+    """Return the reason the filters of the request are invalid, None if they are valid"""
+    try:
+        parse_filter(data)
+    except ValueError as exception:
+        return str(exception)
+
+    return None
+
+def cached_job(method):
+    """Decorate a DataParser method so that repeated jobs reuse the serialized result"""
+    @functools.wraps(method)
+    def wrapper(parser, data, job_id=None):
+        # Direct calls return dataframes, only the job results are cached
+        if job_id is None:
+            return method(parser, data, job_id)
+
+        key = make_key(method.__name__, data)
+        result = parser.cache.get(key)
+        if result is None:
+            # Read the generation before the index, a result of the data before an append
+            # is then dropped by the cache
+            generation = parser.cache.generation
+            result = method(parser, data, job_id)
+            parser.cache.put(key, result, generation)
+            return result
+
+        # Skip both the computation and the serialization
+        parser.job_maintainer.start_job(job_id)
+        parser.results.put(job_id, result)
+        parser.job_maintainer.finish_job(job_id)
+
+        return result
+
+    return wrapper
 
 class DataParser:
     """This class is responsible for parsing the data and returning the results as a JSON file"""
-    def __init__(self, data: DataIngestor):
-        """Initialize the class with the data from the DataIngestor class"""
-        self.job_maintainer = JobMaintainer()
+    # Endpoints that can be part of a batch query
+    batch_endpoints = ['states_mean', 'state_mean', 'best5', 'worst5', 'global_mean',
+                       'diff_from_mean', 'state_diff_from_mean', 'mean_by_category',
+                       'state_mean_by_category']
+
+    # Estimated run time in seconds of the job of each method, refined by the task runner
+    # from the measured ones. Single-state lookups are the cheapest, the categories the
+    # most expensive
+    job_costs = {'state_mean': 0.0002, 'global_mean': 0.0002, 'state_diff_from_mean': 0.0002,
+                 'states_mean': 0.0005, 'best5': 0.0005, 'worst5': 0.0005,
+                 'diff_from_mean': 0.0005, 'state_mean_by_category': 0.005,
+                 'mean_by_category': 0.01, 'batch': 0.01}
+
+    # Questions for which the best states are the ones with the lowest values
+    questions_best_is_min = [
+        'Percent of adults aged 18 years and older who have an overweight classification',
+        'Percent of adults aged 18 years and older who have obesity',
+        'Percent of adults who engage in no leisure-time physical activity',
+        'Percent of adults who report consuming fruit less than one time daily',
+        'Percent of adults who report consuming vegetables less than one time daily'
+    ]
+
+    # Questions for which the best states are the ones with the highest values
+    questions_best_is_max = [
+        'Percent of adults who achieve at least 150 minutes a week of moderate-intensity '
+        'aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic '
+        'activity (or an equivalent combination)',
+
+        'Percent of adults who achieve at least 150 minutes a week of moderate-intensity '
+        'aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic '
+        'physical activity and engage in muscle-strengthening activities on 2 or more days '
+        'a week',
+
+        'Percent of adults who achieve at least 300 minutes a week of moderate-intensity '
+        'aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic '
+        'activity (or an equivalent combination)',
+
+        'Percent of adults who engage in muscle-strengthening activities on 2 or more days '
+        'a week',
+    ]
+
+    def __init__(self, data: DataIngestor, job_maintainer=None, results=None):
+        """Initialize the class with the data from the DataIngestor class. The jobs and their
+        results can be shared with another parser, e.g. the one of the previous dataset"""
+        self.results = results if results is not None else ResultStore()
+        if job_maintainer is None:
+            job_maintainer = JobMaintainer(JobRetention(on_evict=self.results.delete))
+        self.job_maintainer = job_maintainer
         self.data_ingestor = data
         self.data = data.get()
+        self.index = DataIndex(self.data, data.aggregates)
+        self.cache = ResultCache()
         self.logger = Logger()
 
-        self.questions_best_is_min = [
-            'Percent of adults aged 18 years and older who have an overweight classification',
-            'Percent of adults aged 18 years and older who have obesity',
-            'Percent of adults who engage in no leisure-time physical activity',
-            'Percent of adults who report consuming fruit less than one time daily',
-            'Percent of adults who report consuming vegetables less than one time daily'
-        ]
+    def append(self, csv_source):
+        """Append the rows of a csv chunk to the data and add their sums and counts to the
+        index, without recomputing the rest of it. Return the number of rows appended"""
+        rows = self.data_ingestor.append_csv(csv_source)
+        self.data = self.data_ingestor.get()
+        self.index.append(rows)
 
-        self.questions_best_is_max = [
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity '
-            'aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic '
-            'activity (or an equivalent combination)',
+        # The cached results may be out of date
+        self.cache.clear()
 
-            'Percent of adults who achieve at least 150 minutes a week of moderate-intensity '
-            'aerobic physical activity or 75 minutes a week of vigorous-intensity aerobic '
-            'physical activity and engage in muscle-strengthening activities on 2 or more days '
-            'a week',
+        self.logger.info("Appended %d rows to the data.", len(rows))
+        return len(rows)
 
-            'Percent of adults who achieve at least 300 minutes a week of moderate-intensity '
-            'aerobic physical activity or 150 minutes a week of vigorous-intensity aerobic '
-            'activity (or an equivalent combination)',
-
-            'Percent of adults who engage in muscle-strengthening activities on 2 or more days '
-            'a week',
-        ]
+    @timed('job_stage_seconds', stage='index')
+    def question_index(self, data):
+        """Return the index of the question of the request, restricted to the years and the
+        stratification the request selects"""
+        return self.index.get(data['question'], parse_filter(data))
 
     def get_global_mean(self, data):
         """Compute the global mean of the data values in the the interval 2011-2022"""
         # Computes the global mean of the data values for the question in the the interval 2011-2022
-        # Extract question from data
-        question = data['question']
-        # Filter data for the question
-        data_filtered = self.data[self.data['Question'] == question]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Compute the global mean of the data values
-        data_mean = data_filtered['Data_Value'].mean()
+        # Take the global mean of the data values from the summary of the question
+        data_mean = self.question_index(data).summary().global_mean
         data_mean = pd.DataFrame({'Data_Value': [data_mean]})
 
         # Return data_mean as value
         return data_mean
 
+    @cached_job
     def states_mean(self, data, job_id=None):
         """Compute the mean of the data values for each state and order ascendingly by mean"""
         # Start job
@@ -81,27 +214,21 @@ class DataParser:
         if question in self.questions_best_is_min:
             best_is_min = True
 
-        # Filter data for the question
-        data_filtered = self.data[self.data['Question'] == question]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Compute the mean of the data values for each state
-        data_mean = data_filtered.groupby('LocationDesc')['Data_Value'].mean().reset_index()
-        data_mean = data_mean.sort_values('Data_Value', ascending=best_is_min)
+        # Order the means of the states from the summary of the question
+        data_mean = self.question_index(data).summary().sorted_by_mean(ascending=best_is_min)
 
         if job_id is not None:
             self.logger.info("Got question: %s and outputted %d results.", question, len(data_mean))
 
-            # Write the results in results/ directory with the name of the job_id as json file
-            json_writer(data_mean, job_id)
+            # Store the results under the job_id in the result store
+            result = json_writer(self.results, data_mean, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return data_mean
 
+    @cached_job
     def state_mean(self, data, job_id=None):
         """Compute the mean of the data values for the state in the the interval 2011-2022"""
         # Start job
@@ -112,28 +239,22 @@ class DataParser:
         question = data['question']
         state = data['state']
 
-        # Filter data for the question and state
-        data_filtered = self.data[(self.data['Question'] == question) &
-                                  (self.data['LocationDesc'] == state)]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Create the mean result from filter
-        data_mean = data_filtered['Data_Value'].mean()
+        # Look up the mean of the state in the summary of the question
+        data_mean = self.question_index(data).summary().state_mean(state)
         data_mean = pd.DataFrame({'LocationDesc': [state], 'Data_Value': [data_mean]})
 
         if job_id is not None:
             self.logger.info("Got question: %s and outputted 1 result.", question)
 
-            # Write the results in results/ directory with the name of the job_id as json file
-            json_writer(data_mean, job_id)
+            # Store the results under the job_id in the result store
+            result = json_writer(self.results, data_mean, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return data_mean
 
+    @cached_job
     def best5(self, data, job_id=None):
         """Compute the best 5 states for the question in the the interval 2011-2022"""
         # Start job
@@ -146,15 +267,8 @@ class DataParser:
         if question in self.questions_best_is_min:
             best_is_min = True
 
-        # Filter data for the question
-        data_filtered = self.data[self.data['Question'] == question]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Compute the mean of the data values for each state
-        data_mean = data_filtered.groupby('LocationDesc')['Data_Value'].mean().reset_index()
-        data_mean = data_mean.sort_values('Data_Value', ascending=best_is_min)
+        # Order the means of the states from the summary of the question
+        data_mean = self.question_index(data).summary().sorted_by_mean(ascending=best_is_min)
 
         # Get the best 5 states
         data_best5 = data_mean.head(5)
@@ -162,14 +276,15 @@ class DataParser:
         if job_id is not None:
             self.logger.info("Got question: %s and outputted 5 results.", question)
 
-            # Write the results in results/ directory with the name of the job_id as json file
-            json_writer(data_best5, job_id)
+            # Store the results under the job_id in the result store
+            result = json_writer(self.results, data_best5, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return data_best5
 
+    @cached_job
     def worst5(self, data, job_id=None):
         """Compute the worst 5 states for the question in the the interval 2011-2022"""
         # Start job
@@ -182,30 +297,21 @@ class DataParser:
         if question in self.questions_best_is_min:
             best_is_min = True
 
-        # Filter data for the question
-        data_filtered = self.data[self.data['Question'] == question]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Compute the mean of the data values for each state
-        data_mean = data_filtered.groupby('LocationDesc')['Data_Value'].mean().reset_index()
-        data_mean = data_mean.sort_values('Data_Value', ascending=not best_is_min)
-
-        # Get the worst 5 states
-        data_worst5 = data_mean.head(5)
+        # Get the worst 5 states from the summary of the question
+        data_worst5 = self.question_index(data).summary().head(ascending=not best_is_min)
 
         self.logger.info("Got question: %s and outputted 5 results.", question)
 
         if job_id is not None:
-            # Write the results in results/ directory with the name of the job_id as json file
-            json_writer(data_worst5, job_id)
+            # Store the results under the job_id in the result store
+            result = json_writer(self.results, data_worst5, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return data_worst5
 
+    @cached_job
     def global_mean(self, data, job_id=None):
         """Compute the global mean of the data values for the question in interval 2011-2022"""
         # Start job
@@ -221,14 +327,14 @@ class DataParser:
 
             # Create output as {"global_mean" : value}
             data_dict = {"global_mean": data_mean['Data_Value'].values[0]}
-            with open(f'results/{job_id}.json', 'w', encoding="utf-8") as file:
-                # Write field:value pairs in json format
-                json.dump(data_dict, file)
+            result = dict_writer(self.results, data_dict, job_id)
+
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return data_mean
 
+    @cached_job
     def diff_from_mean(self, data, job_id=None):
         """Compute the difference of the data values for each state from the global mean
         in the the interval 2011-2022"""
@@ -240,31 +346,21 @@ class DataParser:
         # Extract question from data
         question = data['question']
 
-        # Filter data for the question
-        data_filtered = self.data[self.data['Question'] == question]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Compute the global mean of the data values
-        global_mean = self.get_global_mean(data)
-        global_mean = global_mean['Data_Value'].values[0]
-
-        # Create dict with differences between the global mean and the state mean
-        data_diff = data_filtered.groupby('LocationDesc')['Data_Value'].mean().reset_index()
-        data_diff['Data_Value'] = global_mean - data_diff['Data_Value']
+        # Subtract the mean of each state from the global mean in the summary of the question
+        data_diff = self.question_index(data).summary().diff_from_mean()
 
         if job_id is not None:
             self.logger.info("Got question: %s and outputted %d results.", question, len(data_diff))
 
-            # Write the results in results/ directory with the name of the job_id as json file
-            json_writer(data_diff, job_id)
+            # Store the results under the job_id in the result store
+            result = json_writer(self.results, data_diff, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return data_diff
 
+    @cached_job
     def state_diff_from_mean(self, data, job_id=None):
         """Compute the difference of the data values for the state from the global mean
           in the the interval 2011-2022"""
@@ -277,35 +373,22 @@ class DataParser:
         question = data['question']
         state = data['state']
 
-        # Filter data for the question and state
-        data_filtered = self.data[(self.data['Question'] == question) &
-                                  (self.data['LocationDesc'] == state)]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Compute the global mean of the data values
-        global_mean = self.get_global_mean(data)
-        global_mean = global_mean['Data_Value'].values[0]
-
-        # Create dict with differences between the global mean and the state mean
-        data_diff = data_filtered['Data_Value'].mean()
-        data_diff = global_mean - data_diff
+        # Subtract the mean of the state from the global mean in the summary of the question
+        data_diff = self.question_index(data).summary().state_diff_from_mean(state)
 
         if job_id is not None:
             self.logger.info("Got question: %s and outputted 1 result.", question)
 
             # Create a dict with a value state and the difference
             data_dict = {state: data_diff}
-            with open(f'results/{job_id}.json', 'w', encoding="utf-8") as file:
-                # Write field:value pairs in json format
-                json.dump(data_dict, file)
+            result = dict_writer(self.results, data_dict, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return data_diff
 
+    @cached_job
     def mean_by_category(self, data, job_id=None):
         """Compute the mean of the data values for each category for each state
           in the the interval 2011-2022"""
@@ -317,39 +400,25 @@ class DataParser:
         # Extract question from data
         question = data['question']
 
-        # Filter data for the question
-        data_filtered = self.data[self.data['Question'] == question]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
         # Compute the mean of the data values for each state and category
-        data_mean = data_filtered.groupby(['LocationDesc', 'StratificationCategory1',
-                                           'Stratification1'])['Data_Value'].mean().reset_index()
+        data_mean = self.question_index(data).categories_mean()
 
         self.logger.info("Got question: %s and outputted %d results.", question, len(data_mean))
 
         # Prepare the result dictionary
-        result = {}
-
-        for _, row in data_mean.iterrows():
-            key = (
-                f"('{row['LocationDesc']}', '{row['StratificationCategory1']}', "
-                f"'{row['Stratification1']}')"
-            )
-            result[key] = row['Data_Value']
-
+        result = category_dict(data_mean, ['LocationDesc', 'StratificationCategory1',
+                                           'Stratification1'])
 
         if job_id is not None:
-            # Save the dictionary as a JSON file in the specified path
-            with open(f'results/{job_id}.json', 'w', encoding="utf-8") as file:
-                json.dump(result, file)
+            # Store the dictionary as JSON under the job_id in the result store
+            result = dict_writer(self.results, result, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return result
 
+    @cached_job
     def state_mean_by_category(self, data, job_id=None):
         """Compute the mean of the data values for each category for the state in
           the the interval 2011-2022"""
@@ -362,40 +431,64 @@ class DataParser:
         question = data['question']
         state = data['state']
 
-        # Filter data for the question and state
-        data_filtered = self.data[(self.data['Question'] == question) &
-                                  (self.data['LocationDesc'] == state)]
-        data_filtered = data_filtered[(data_filtered['YearStart'] >= 2011) &
-                                      (data_filtered['YearEnd'] <= 2022)]
-
-        # Drop rows where 'Data_Value' is NaN because we cannot compute mean of NaN values
-        data_filtered = data_filtered.dropna(subset=['Data_Value'])
-
-        # Compute the mean of the data values for each category
-        data_mean = (
-            data_filtered
-            .groupby(['StratificationCategory1', 'Stratification1'])['Data_Value']
-            .mean()
-            .reset_index()
-        )
+        # Compute the mean of the data values for each category from the index of the question
+        data_mean = self.question_index(data).state_categories_mean(state)
 
         self.logger.info("Got question: %s and outputted %d results.", question, len(data_mean))
 
         # Prepare the result dictionary
-        result = {state: {}}
-        for _, row in data_mean.iterrows():
-            category_description = (
-                f"('{row['StratificationCategory1']}', "
-                f"'{row['Stratification1']}')"
-            )
-            result[state][category_description] = row['Data_Value']
+        result = {state: category_dict(data_mean, ['StratificationCategory1', 'Stratification1'])}
 
         if job_id is not None:
-            # Save the dictionary as a JSON file in the specified path
-            with open(f'results/{job_id}.json', 'w', encoding="utf-8") as file:
-                json.dump(result, file)
+            # Store the dictionary as JSON under the job_id in the result store
+            result = dict_writer(self.results, result, job_id)
 
             self.job_maintainer.finish_job(job_id)
-            return None
+            return result
 
         return result
+
+    @cached_job
+    def batch(self, data, job_id=None):
+        """Answer a list of {endpoint, question, state} queries as a single job"""
+        # Start job
+        self.job_maintainer.start_job(job_id)
+
+        # Group the queries by question so each question index is looked up once
+        by_question = {}
+        for position, query in enumerate(data):
+            by_question.setdefault(query.get('question'), []).append(position)
+
+        answers = [None] * len(data)
+        for question, positions in by_question.items():
+            self.index.get(question).summary()
+
+            for position in positions:
+                query = data[position]
+                endpoint = query.get('endpoint')
+                answer = {"endpoint": endpoint, "question": question}
+                if 'state' in query:
+                    answer['state'] = query['state']
+
+                filter_error = invalid_filter(query)
+                if endpoint not in self.batch_endpoints:
+                    answer['error'] = "Invalid endpoint"
+                elif endpoint.startswith('state_') and 'state' not in query:
+                    answer['error'] = "Missing state"
+                elif filter_error is not None:
+                    answer['error'] = filter_error
+                else:
+                    result = getattr(self, endpoint)(query)
+                    answer['data'] = to_result_dict(endpoint, query, result)
+                answers[position] = answer
+
+        self.logger.info("Got batch of %d queries for %d questions.", len(data), len(by_question))
+
+        if job_id is not None:
+            # Store the answers as JSON under the job_id in the result store
+            result = dict_writer(self.results, answers, job_id)
+
+            self.job_maintainer.finish_job(job_id)
+            return result
+
+        return answers
@@ -0,0 +1,120 @@
+"""This module converts the data to a columnar binary snapshot that can be memory-mapped, so
+several processes share one physical copy of the dataset"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# File with the column names, the files of their arrays, the category tables and the
+# signature of the csv the snapshot was made from
+META_FILE = 'meta.json'
+
+def file_hash(path: str):
+    """Return the sha256 of the file, read in blocks of 1 MiB"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def csv_signature(csv_path: str):
+    """Return the size, modification time and hash identifying the csv file"""
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(csv_path)}
+
+def is_snapshot_valid(path: str, csv_path: str):
+    """Check if the snapshot in path was made from the current content of the csv file"""
+    try:
+        with open(os.path.join(path, META_FILE), 'r', encoding="utf-8") as file:
+            source = json.load(file)['source']
+
+        # Size and modification time are checked first, the hash only when the time changed
+        stat = os.stat(csv_path)
+        if stat.st_size != source['size']:
+            return False
+        if stat.st_mtime_ns == source['mtime_ns']:
+            return True
+
+        return file_hash(csv_path) == source['sha256']
+    except (OSError, ValueError, KeyError, TypeError):
+        # A missing csv, or a snapshot without a readable signature
+        return False
+
+def write_snapshot(data: pd.DataFrame, path: str, csv_path: str = None):
+    """Write the data in path as one .npy array per column, the categorical columns as codes,
+    recording the signature of the csv_path it was read from"""
+    # Write in a temporary directory first, so concurrent workers never see half a snapshot
+    parent = os.path.dirname(os.path.abspath(path))
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.snapshot-')
+
+    meta = {'columns': []}
+    if csv_path is not None:
+        meta['source'] = csv_signature(csv_path)
+
+    for position, column in enumerate(data.columns):
+        series = data[column]
+
+        # Strings are stored as integer codes plus the table of categories
+        if series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+            series = series.astype('category')
+
+        entry = {'name': column, 'file': f'{position}.npy'}
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            entry['categories'] = series.cat.categories.tolist()
+            values = series.cat.codes.to_numpy()
+        else:
+            values = series.to_numpy()
+
+        np.save(os.path.join(tmp_path, entry['file']), values)
+        meta['columns'].append(entry)
+
+    with open(os.path.join(tmp_path, META_FILE), 'w', encoding="utf-8") as file:
+        json.dump(meta, file)
+
+    # Move a stale snapshot out of the way, the processes using it keep their mapping
+    old_path = None
+    if os.path.exists(path):
+        old_path = tempfile.mkdtemp(dir=parent, prefix='.snapshot-old-')
+        try:
+            os.rename(path, os.path.join(old_path, 'snapshot'))
+        except OSError:
+            pass
+
+    # Publish the snapshot, keeping the one of another worker if it was faster
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+def load_snapshot(path: str):
+    """Load the snapshot in path as a dataframe backed by read-only memory-mapped arrays"""
+    with open(os.path.join(path, META_FILE), 'r', encoding="utf-8") as file:
+        meta = json.load(file)
+
+    if not meta.get('columns'):
+        raise ValueError(f"Snapshot {path} has no columns")
+
+    columns = {}
+    for entry in meta['columns']:
+        values = np.load(os.path.join(path, entry['file']), mmap_mode='r')
+        if 'categories' in entry:
+            values = pd.Categorical.from_codes(values, categories=entry['categories'])
+        columns[entry['name']] = values
+
+    # Do not copy the arrays, so every process reads the same pages of the files
+    return pd.DataFrame(columns, copy=False)
+
+def try_load_snapshot(path: str):
+    """Load the snapshot in path, None if its files are damaged, e.g. a truncated array or a
+    meta.json without the columns"""
+    try:
+        return load_snapshot(path)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError, IndexError, EOFError):
+        return None
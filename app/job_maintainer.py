@@ -1,25 +1,220 @@
 """This module contains the JobMaintainer class"""
+import itertools
+import os
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+# Statuses of the jobs that ended: done with a result, cancelled or expired before they started,
+# or failed with an error as result
+END_STATUSES = ('done', 'cancelled', 'expired', 'failed')
+
+# Most job ids a page of jobs scans for each job it can hold, so the cost of a page filtered
+# by status depends on its size and not on the number of retained jobs
+JOBS_SCAN_FACTOR = 10
+
+class JobRetention:
+    """Retention policy that evicts the finished jobs over max_jobs or older than max_age"""
+    def __init__(self, max_jobs=None, max_age=None, on_evict=None):
+        """Initialize the policy, calling on_evict with the id of every evicted job"""
+        if max_jobs is None:
+            max_jobs = int(os.environ.get('JOBS_MAX_RETAINED', 10000))
+        if max_age is None:
+            max_age = float(os.environ.get('JOBS_MAX_AGE', 3600))
+
+        self.max_jobs = max_jobs
+        self.max_age = max_age
+        self.on_evict = on_evict
+
+        # Finish time of the finished jobs, in the order they finished
+        self.finished = OrderedDict()
+
+    def add(self, job_id):
+        """Record that the job with the given job_id has finished"""
+        self.finished[job_id] = time.monotonic()
+
+    def expired(self):
+        """Remove and return the ids of the finished jobs that must be evicted"""
+        now = time.monotonic()
+        job_ids = []
+
+        # The oldest finished jobs are at the front
+        while self.finished:
+            job_id, finish_time = next(iter(self.finished.items()))
+            if len(self.finished) <= self.max_jobs and now - finish_time < self.max_age:
+                break
+            del self.finished[job_id]
+            job_ids.append(job_id)
+
+        return job_ids
 
 class JobMaintainer:
-    """Class to maintain the status of jobs"""
-    def __init__(self):
+    """Class to maintain the ids and the status of jobs"""
+    def __init__(self, retention=None):
         """Initialize the JobMaintainer class"""
-        self.running_jobs = set()
-        self.done_jobs = set()
+        # Job ids are handed out by an atomic counter, starting from 1
+        self.job_ids = itertools.count(1)
+        self.last_job_id = 0
+        self.first_job_id = 1
+
+        # Single table with the status of every retained job: queued, running, done,
+        # cancelled or expired
+        self.statuses = {}
+        self.retention = retention if retention is not None else JobRetention()
+
+        # Completion events of the jobs that requests are waiting for
+        self.waiting_jobs = {}
+        self.lock = Lock()
+
+    def new_job(self):
+        """Allocate the id of a new job and register it as queued"""
+        # Concurrent requests never share an id and last_job_id never goes backwards
+        with self.lock:
+            job_id = next(self.job_ids)
+            self.statuses[job_id] = 'queued'
+            self.last_job_id = max(self.last_job_id, job_id)
+
+        return job_id
+
+    def register_job(self, job_id):
+        """Register a job with an id allocated by the caller as queued, unless it is known"""
+        with self.lock:
+            if job_id not in self.statuses:
+                self.statuses[job_id] = 'queued'
+                self.last_job_id = max(self.last_job_id, job_id)
+
+    def has_job(self, job_id):
+        """Check if a job with the given job_id was submitted and is still retained"""
+        return job_id in self.statuses
+
+    def get_status(self, job_id):
+        """Get the status of the job with the given job_id, None if it is unknown"""
+        return self.statuses.get(job_id)
 
     def is_job_running(self, job_id):
-        """Check if a job with the given job_id is running"""
-        return job_id in self.running_jobs
+        """Check if a job with the given job_id is queued or running"""
+        return self.statuses.get(job_id) in ('queued', 'running')
 
     def is_job_done(self, job_id):
         """Check if a job with the given job_id is done"""
-        return job_id in self.done_jobs
+        return self.statuses.get(job_id) == 'done'
+
+    def _end_job(self, job_id, status):
+        """Set the final status of a job, the lock being held. Return the event of the
+        requests waiting for it, to be set once the lock is released"""
+        self.statuses[job_id] = status
+        self.retention.add(job_id)
+        return self.waiting_jobs.pop(job_id, None)
 
     def finish_job(self, job_id):
         """Finish a job with the given job_id"""
-        self.running_jobs.remove(job_id)
-        self.done_jobs.add(job_id)
+        with self.lock:
+            event = self._end_job(job_id, 'done')
+
+        # Wake up the requests waiting for the job
+        if event is not None:
+            event.set()
+
+        self.evict_jobs()
+
+    def fail_job(self, job_id):
+        """Fail a job with the given job_id that could not run"""
+        with self.lock:
+            event = self._end_job(job_id, 'failed')
+
+        # Wake up the requests waiting for the job
+        if event is not None:
+            event.set()
+
+        self.evict_jobs()
+
+    def cancel_job(self, job_id):
+        """Cancel a queued job with the given job_id, return False if it already started"""
+        with self.lock:
+            if self.statuses.get(job_id) != 'queued':
+                return False
+            event = self._end_job(job_id, 'cancelled')
+
+        # Wake up the requests waiting for the job
+        if event is not None:
+            event.set()
+
+        self.evict_jobs()
+        return True
+
+    def claim_job(self, job_id, deadline=None):
+        """Mark a queued job as running when a worker takes it. Return False if the job was
+        cancelled, or if the monotonic deadline passed, in which case it expires"""
+        with self.lock:
+            if self.statuses.get(job_id) != 'queued':
+                return False
+            if deadline is None or time.monotonic() <= deadline:
+                self.statuses[job_id] = 'running'
+                return True
+            event = self._end_job(job_id, 'expired')
+
+        # Wake up the requests waiting for the job
+        if event is not None:
+            event.set()
+
+        self.evict_jobs()
+        return False
 
     def start_job(self, job_id):
-        """Start a job with the given job_id"""
-        self.running_jobs.add(job_id)
+        """Start a job with the given job_id, direct calls without a job are not tracked"""
+        if job_id is not None:
+            self.statuses[job_id] = 'running'
+
+    def wait_job(self, job_id, timeout):
+        """Wait at most timeout seconds for the job to end and return if it is done"""
+        with self.lock:
+            status = self.statuses.get(job_id)
+            if status in END_STATUSES:
+                return status == 'done'
+            event = self.waiting_jobs.setdefault(job_id, Event())
+
+        return event.wait(timeout) and self.statuses.get(job_id) == 'done'
+
+    def evict_jobs(self):
+        """Drop the finished jobs that are no longer retained"""
+        with self.lock:
+            job_ids = self.retention.expired()
+            for job_id in job_ids:
+                self.statuses.pop(job_id, None)
+
+            # Move past the evicted jobs so pages do not scan them again
+            while self.first_job_id <= self.last_job_id and self.first_job_id not in self.statuses:
+                self.first_job_id += 1
+
+        # Drop the results of the evicted jobs
+        if self.retention.on_evict is not None:
+            for job_id in job_ids:
+                self.retention.on_evict(job_id)
+
+    def jobs(self, cursor=1, limit=100, status=None):
+        """Return a page of at most limit (job_id, status) pairs starting from the cursor job_id,
+        optionally only with the given status, and the cursor of the next page or None. A page
+        scans at most JOBS_SCAN_FACTOR * limit job ids, so it can hold fewer jobs than limit
+        when the cursor of the next page is not None"""
+        self.evict_jobs()
+
+        page = []
+        limit = max(limit, 1)
+        job_id = max(cursor, self.first_job_id)
+        end = job_id + JOBS_SCAN_FACTOR * limit
+        while len(page) < limit and job_id < end:
+            job_status = self.statuses.get(job_id)
+
+            # Stop after the last submitted job
+            if job_status is None and job_id > self.last_job_id:
+                return page, None
+
+            if job_status is not None and status in (None, job_status):
+                page.append((job_id, job_status))
+            job_id += 1
+
+        return page, job_id
+
+    def num_jobs(self):
+        """Return the number of jobs that have been submitted"""
+        return self.last_job_id
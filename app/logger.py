@@ -1,15 +1,39 @@
 """This module sets up a logger for the web server."""
+import atexit
+import itertools
 import logging
+import os
+import queue
 import time
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-def setup_logger(level=logging.INFO):
-    """Set up a logger for the web server."""
-    logger = logging.getLogger('WebServerLogger')
+# Threads writing the records of the asynchronous loggers, by logger name
+LISTENERS = {}
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler that leaves the formatting of the records to the listener thread"""
+    def prepare(self, record):
+        """Enqueue the record as it is, the listener runs in the same process"""
+        return record
+
+def setup_logger(level=None, name='WebServerLogger', path='webserver.log', asynchronous=None):
+    """Set up a logger for the web server. The level, the size of the log files and the
+    asynchronous mode default to LOG_LEVEL, LOG_MAX_BYTES and LOG_ASYNC."""
+    if level is None:
+        level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    if asynchronous is None:
+        asynchronous = os.environ.get('LOG_ASYNC', '0') == '1'
+
+    logger = logging.getLogger(name)
     logger.setLevel(level)
 
+    # Every parser sets up the logger, add the handler only once
+    if logger.handlers:
+        return logger
+
     # Create a rotating file handler
-    handler = RotatingFileHandler('webserver.log', maxBytes=10240, backupCount=5)
+    handler = RotatingFileHandler(path, maxBytes=int(os.environ.get('LOG_MAX_BYTES', 10240)),
+                                  backupCount=int(os.environ.get('LOG_BACKUP_COUNT', 5)))
     handler.setLevel(level)
 
     # Create a logging format with UTC timestamps
@@ -18,16 +42,68 @@ def setup_logger(level=logging.INFO):
     formatter.converter = time.gmtime  # Use UTC time
     handler.setFormatter(formatter)
 
+    if asynchronous:
+        # The request threads only enqueue the records, a listener thread formats them and
+        # writes and rotates the files
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, handler, respect_handler_level=True)
+        listener.start()
+        LISTENERS[name] = listener
+        handler = DeferredQueueHandler(records)
+
     # Add the handler to the logger
     logger.addHandler(handler)
 
     return logger
 
+def stop_logger(name='WebServerLogger'):
+    """Write the queued records of an asynchronous logger and stop its listener thread"""
+    listener = LISTENERS.pop(name, None)
+    if listener is None:
+        return
+
+    listener.stop()
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+def setup_worker_logger(name='WebServerLogger', path='webserver.log'):
+    """Set up the logger in a worker process forked by the server. The handlers inherited from
+    the server are dropped, the listener thread of an asynchronous logger does not run in the
+    worker. The worker writes its records synchronously, since it exits without running the
+    atexit functions that write the queued ones"""
+    LISTENERS.pop(name, None)
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    return setup_logger(name=name, path=path, asynchronous=False)
+
+# Write the records still queued when the server exits
+atexit.register(lambda: [stop_logger(name) for name in list(LISTENERS)])
+
+class SilentLogger:
+    """Logger that drops the messages, returned for the requests left out of the sample"""
+    def info(self, msg, *args, **kwargs):
+        """Drop the message."""
+
+    def error(self, msg, *args, **kwargs):
+        """Drop the message."""
+
+SILENT_LOGGER = SilentLogger()
+
 class Logger:
     """Class to set up a logger for the web server."""
-    def __init__(self):
+    def __init__(self, sample_rate=None):
+        """Set up the logger. Only one in sample_rate of the frequent requests is logged,
+        LOG_SAMPLE_RATE by default"""
         self.logger = setup_logger()
 
+        if sample_rate is None:
+            sample_rate = int(os.environ.get('LOG_SAMPLE_RATE', 1))
+        self.sample_rate = max(sample_rate, 1)
+        self.requests = itertools.count()
+
     def info(self, msg, *args, **kwargs):
         """Log 'msg % args' with severity 'INFO'."""
         self.logger.info(msg, *args, **kwargs)
@@ -36,3 +112,9 @@ class Logger:
     def error(self, msg, *args, **kwargs):
         """Log 'msg % args' with severity 'ERROR'."""
         self.logger.error(msg, *args, **kwargs)
+
+    def sampled(self):
+        """Return this logger for one in sample_rate requests, a silent one for the others."""
+        if next(self.requests) % self.sample_rate == 0:
+            return self
+        return SILENT_LOGGER
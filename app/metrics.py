@@ -0,0 +1,115 @@
+"""This module keeps the latency histograms of the server and renders them, with the state of
+the task runner, in the Prometheus text format"""
+import bisect
+import functools
+import time
+from threading import Lock
+
+# Upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Description of every metric, written in its HELP line
+HELP = {
+    'job_queue_wait_seconds': "Time from the submission of a job to its start",
+    'job_duration_seconds': "Time to compute, serialize and store the result of a job",
+    'job_stage_seconds': "Time spent in each stage of a job in the parser",
+    'result_fetch_seconds': "Time to look up and send the result of a get_results request, "
+                            "without the wait for the job",
+    'task_queue_depth': "Jobs submitted to the task runner that did not start yet",
+    'task_active_workers': "Workers of the task runner running a job",
+}
+
+def format_labels(labels):
+    """Format the (name, value) pairs of the labels as {name="value",...}"""
+    if not labels:
+        return ''
+
+    # Escape the characters that end a label value
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+class Histogram:
+    """Counts of the observed values in each bucket, with their sum"""
+    def __init__(self, buckets=BUCKETS):
+        """Initialize an empty histogram with the given upper bounds"""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        """Count the value in the first bucket whose upper bound is not below it"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def render(self, name, labels):
+        """Return the lines of the histogram, with the cumulative count of each bucket"""
+        lines = []
+        cumulative = 0
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+
+        lines.append(f'{name}_sum{format_labels(labels)} {self.total}')
+        lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+class Metrics:
+    """Registry of the latency histograms of the server, one per metric and labels"""
+    def __init__(self):
+        """Initialize the registry without any histogram"""
+        self.histograms = {}
+        self.lock = Lock()
+
+    def observe(self, name, value, **labels):
+        """Count a value in the histogram of the metric with the given labels"""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def clear(self):
+        """Drop all the histograms"""
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self, gauges=None):
+        """Return the histograms and the given gauge values in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    lines.extend(histogram.render(name, labels))
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+# Metrics of this process, shared by the task runner, the parser and the routes
+METRICS = Metrics()
+
+def timed(name, **labels):
+    """Decorate a function so that every call is counted in the histogram of the metric"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.observe(name, time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
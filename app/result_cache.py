@@ -0,0 +1,64 @@
+"""This module contains the ResultCache class that memoizes the serialized job results"""
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
+
+def make_key(endpoint, data):
+    """Build the cache key of a request from the endpoint and the normalized payload"""
+    # Sort the fields so the same payload always gives the same key
+    return endpoint, json.dumps(data, sort_keys=True)
+
+class ResultCache:
+    """Bounded LRU cache of serialized results keyed by endpoint and request payload"""
+    def __init__(self, max_size=None):
+        """Initialize the cache with at most max_size results"""
+        if max_size is None:
+            max_size = int(os.environ.get('RESULT_CACHE_SIZE', 1024))
+
+        self.max_size = max_size
+        self.results = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # Bumped by every clear, so the results computed before it are not put back
+        self.generation = 0
+
+    def get(self, key):
+        """Return the cached result for the key or None, counting hits and misses"""
+        with self.lock:
+            if key not in self.results:
+                self.misses += 1
+                return None
+
+            # Mark the result as the most recently used one
+            self.results.move_to_end(key)
+            self.hits += 1
+            return self.results[key]
+
+    def put(self, key, result, generation=None):
+        """Store the result for the key, evicting the least recently used results. A result
+        computed in an older generation than the current one is dropped"""
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.results[key] = result
+            self.results.move_to_end(key)
+
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def clear(self):
+        """Drop all the cached results and start a new generation"""
+        with self.lock:
+            self.results.clear()
+            self.generation += 1
+
+    def stats(self):
+        """Return the number of hits, misses and cached results"""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.results)}
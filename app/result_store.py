@@ -0,0 +1,111 @@
+"""This module contains the result stores that keep the serialized results of the jobs, as the
+bytes of the response sent for them"""
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+class MemoryResultStore:
+    """Bounded in-memory store of results, evicting the oldest and the expired ones"""
+    def __init__(self, max_size=None, ttl=None):
+        """Initialize the store with at most max_size results kept for ttl seconds"""
+        if max_size is None:
+            max_size = int(os.environ.get('RESULT_STORE_SIZE', 10000))
+        if ttl is None:
+            ttl = float(os.environ.get('RESULT_STORE_TTL', 3600))
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.results = OrderedDict()
+        self.lock = Lock()
+
+    def _evict(self, now):
+        """Drop the expired results and the oldest ones over the size limit"""
+        # Results are ordered by insertion time, so the expired ones are at the front
+        while self.results:
+            job_id, (timestamp, _) = next(iter(self.results.items()))
+            if len(self.results) <= self.max_size and now - timestamp < self.ttl:
+                break
+            del self.results[job_id]
+
+    def put(self, job_id, result):
+        """Store the result of the job"""
+        now = time.monotonic()
+        with self.lock:
+            self.results[job_id] = (now, result)
+            self.results.move_to_end(job_id)
+            self._evict(now)
+
+    def get(self, job_id):
+        """Return the result of the job, None if it is unknown or expired"""
+        with self.lock:
+            self._evict(time.monotonic())
+            entry = self.results.get(job_id)
+
+        if entry is None:
+            return None
+        return entry[1]
+
+    def delete(self, job_id):
+        """Drop the result of the job"""
+        with self.lock:
+            self.results.pop(job_id, None)
+
+class DiskResultStore:
+    """Store of results as JSON files in the results/ directory"""
+    def __init__(self, directory='results'):
+        """Initialize the store in the given directory, creating it if needed"""
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, job_id, result):
+        """Write the result of the job as a JSON file named after the job_id"""
+        with open(f'{self.directory}/{job_id}.json', 'wb') as file:
+            file.write(result)
+
+    def get(self, job_id):
+        """Read the result of the job, None if there is no file for it"""
+        try:
+            with open(f'{self.directory}/{job_id}.json', 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, job_id):
+        """Remove the file of the job result"""
+        try:
+            os.remove(f'{self.directory}/{job_id}.json')
+        except FileNotFoundError:
+            pass
+
+class ResultStore:
+    """Results kept in memory, with the files on disk as an optional persistence tier"""
+    def __init__(self, memory=None, disk=None):
+        """Initialize the store from its backends, persisting to disk if configured"""
+        if memory is None:
+            memory = MemoryResultStore()
+        if disk is None and os.environ.get('RESULT_STORE_PERSIST', '0') == '1':
+            disk = DiskResultStore()
+
+        self.memory = memory
+        self.disk = disk
+
+    def put(self, job_id, result):
+        """Store the result of the job in every tier"""
+        if self.disk is not None:
+            self.disk.put(job_id, result)
+        self.memory.put(job_id, result)
+
+    def get(self, job_id):
+        """Return the result of the job, from memory first and then from disk"""
+        result = self.memory.get(job_id)
+        if result is None and self.disk is not None:
+            result = self.disk.get(job_id)
+
+        return result
+
+    def delete(self, job_id):
+        """Drop the result of the job from every tier"""
+        self.memory.delete(job_id)
+        if self.disk is not None:
+            self.disk.delete(job_id)
@@ -1,7 +1,29 @@
 """This module contains the definition of the endpoints for the web server."""
-import json
+import hmac
+import io
+import os
+import time
+from threading import Thread
 from flask import request, jsonify
 from app import WEB_SERVER as webserver
+from app import ADMIN_TOKEN, DATASET, DATASET_DIR, reload_dataset
+from app.data_parser import invalid_filter
+from app.metrics import METRICS, timed
+from app.task_runner import AdmissionError
+
+# Longest time in seconds a get_results request may wait for its job to finish
+MAX_WAIT = 30
+
+# Seconds after which clients should retry while the dataset is loading
+RETRY_AFTER = 1
+
+# Status reported by get_results for the jobs without a result
+POLL_STATUSES = {'queued': 'running', 'running': 'running', 'cancelled': 'cancelled',
+                 'expired': 'expired'}
+
+# Default and largest number of jobs in a page of /api/jobs
+JOBS_PAGE_SIZE = 100
+MAX_JOBS_PAGE_SIZE = 1000
 
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
@@ -26,10 +48,15 @@ def post_endpoint():
 
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
-    """Get the response for a job_id. If the job is running, return 'running'."""
+    """Get the response for a job_id. If the job is running, return 'running'.
+    With the optional wait parameter, wait up to that many seconds for the job to finish."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
-    webserver.data_parser.logger.info(f"Entering get_response with job_id: {job_id}")
+    if not is_ready():
+        return not_ready_response()
+    # Jobs are polled often, only a sample of the polls is logged
+    logger = webserver.data_parser.logger.sampled()
+    logger.info(f"Entering get_response with job_id: {job_id}")
 
     # Check if job_id is valid
     # If not, return error
@@ -39,19 +66,25 @@ def get_response(job_id):
     # }
     if (job_id is None or
             not job_id.isdigit() or
-            int(job_id) < 0 or
-            int(job_id) >= webserver.job_counter):
+            not webserver.data_parser.job_maintainer.has_job(int(job_id))):
         return jsonify({
             "status": "error",
             "reason": "Invalid job_id"
         })
 
+    # Block until the job is done or the wait time passes
+    wait = min(request.args.get('wait', default=0, type=float), MAX_WAIT)
+    if wait > 0:
+        webserver.data_parser.job_maintainer.wait_job(int(job_id), wait)
 
-    # Check if job_id is running
-    if webserver.data_parser.job_maintainer.is_job_running(int(job_id)):
-        webserver.data_parser.logger.info(f"Exiting get_response with job_id: {job_id}")
-        return jsonify({'status': 'running'})
+    response = result_response(int(job_id))
+    logger.info(f"Exiting get_response with job_id: {job_id}")
+    return response
 
+@timed('result_fetch_seconds')
+def result_response(job_id):
+    """Respond with the result of the job, or with its status if it has no result. Only this
+    part of get_results is timed, not the wait for the job"""
     # Check if job_id is done and return the result
     #    res = res_for(job_id)
     #    return jsonify({
@@ -59,34 +92,46 @@ def get_response(job_id):
     #        'data': <JSON_PROCESSING_RESULT>
     #    })
 
-    # Read result from results/job_id.json
-    with open(f"results/{job_id}.json", "r", encoding="utf-8") as fin:
-        res = json.load(fin)
+    # Read result from the result store, without touching the filesystem
+    res = webserver.data_parser.results.get(job_id)
+    if res is None:
+        # A job without a result that is not done yet is queued, running, or it was dropped
+        # before it started
+        job_status = webserver.data_parser.job_maintainer.get_status(job_id)
+        if job_status in POLL_STATUSES:
+            return jsonify({'status': POLL_STATUSES[job_status]})
 
-    webserver.data_parser.logger.info(f"Exiting get_response with job_id: {job_id}")
-    return jsonify({
-        'status': 'done',
-        'data': res
-    })
+        return jsonify({
+            "status": "error",
+            "reason": "Result expired"
+        })
+
+    # The result is stored as the bytes of the response, sent without decoding it
+    return json_bytes_response(res)
 
 @webserver.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
     """Endpoint to calculate the mean of the states."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
 
     # Get request data
     data = request.json
     webserver.data_parser.logger.info("Entering states_mean_request with data: {data}")
 
-    # Get current job_id
-    job_id = webserver.job_counter
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.states_mean, data, job_id)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.states_mean, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting states_mean_request with job_id: {job_id}")
     # Return associated job_id
@@ -97,40 +142,50 @@ def state_mean_request():
     """"Endpoint to calculate the mean of a state."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info("Entering state_mean_request with data: {data}")
 
-    # Get current job_id
-    job_id = webserver.job_counter
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Increment job_id counter
-    webserver.job_counter += 1
-
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.state_mean, data, job_id)
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.state_mean, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting state_mean_request with job_id: {job_id}")
-    # Return associated job_id
-    return jsonify({"job_id": job_id})
+    # Return associated job_id, or the result for synchronous requests
+    return job_response(job_id)
 
 @webserver.route('/api/best5', methods=['POST'])
 def best5_request():
     """Endpoint to calculate the best 5 states."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info(f"Got request {data} for best5")
 
-    # Get current job_id
-    job_id = webserver.job_counter
-
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.best5, data, job_id)
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.best5, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting best5_request with job_id: {job_id}")
     # Return associated job_id
@@ -141,18 +196,23 @@ def worst5_request():
     """Endpoint to calculate the worst 5 states."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info(f"Got request {data} for worst5")
 
-    # Get current job_id
-    job_id = webserver.job_counter
-
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.worst5, data, job_id)
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.worst5, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting worst5_request with job_id: {job_id}")
     # Return associated job_id
@@ -163,40 +223,50 @@ def global_mean_request():
     """Endpoint to calculate the global mean."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info(f"Got request {data} for global_mean")
 
-    # Get current job_id
-    job_id = webserver.job_counter
-
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.global_mean, data, job_id)
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.global_mean, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting global_mean_request with job_id: {job_id}")
-    # Return associated job_id
-    return jsonify({"job_id": job_id})
+    # Return associated job_id, or the result for synchronous requests
+    return job_response(job_id)
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
     """Endpoint to calculate the difference from the mean."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info(f"Got request {data} for diff_from_mean")
 
-    # Get current job_id
-    job_id = webserver.job_counter
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.diff_from_mean, data, job_id)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.diff_from_mean, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting diff_from_mean_request with job_id: {job_id}")
     # Return associated job_id
@@ -207,40 +277,50 @@ def state_diff_from_mean_request():
     """Endpoint to calculate the difference from the mean for a state."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info(f"Got request {data} for state_diff_from_mean")
 
-    # Get current job_id
-    job_id = webserver.job_counter
-
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.state_diff_from_mean, data, job_id)
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.state_diff_from_mean, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting state_diff_from_mean_request with job_id: {job_id}")
-    # Return associated job_id
-    return jsonify({"job_id": job_id})
+    # Return associated job_id, or the result for synchronous requests
+    return job_response(job_id)
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
     """Endpoint to calculate the mean by category."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info(f"Got request {data} for mean_by_category")
 
-    # Get current job_id
-    job_id = webserver.job_counter
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.mean_by_category, data, job_id)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.mean_by_category, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting mean_by_category_request with job_id: {job_id}")
     # Return associated job_id
@@ -252,29 +332,65 @@ def state_mean_by_category_request():
     """Endpoint to calculate the mean by category for a state."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     # Get request data
     data = request.json
     webserver.data_parser.logger.info(f"Got request {data} for state_mean_by_category")
 
-    # Get current job_id
-    job_id = webserver.job_counter
+    # The optional year window and stratification of the request must be valid
+    error = filter_error_response(data)
+    if error is not None:
+        return error
 
-    # Register job. Don't wait for task to finish
-    webserver.tasks_runner.__submit__(webserver.data_parser.state_mean_by_category, data, job_id)
-
-    # Increment job_id counter
-    webserver.job_counter += 1
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.state_mean_by_category, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
 
     webserver.data_parser.logger.info(f"Exiting state_mean_by_category_request with id: {job_id}")
     # Return associated job_id
     return jsonify({"job_id": job_id})
 
 
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+    """Endpoint to answer a list of {endpoint, question, state} queries as a single job."""
+    if is_shutdown():
+        return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
+    # Get request data
+    data = request.json
+    webserver.data_parser.logger.info(f"Got request {data} for batch")
+
+    # The batch must be a list of queries, each with an endpoint and a question
+    if not isinstance(data, list) or not all(is_batch_query(query) for query in data):
+        return jsonify({
+            "status": "error",
+            "reason": "Invalid batch"
+        }), 400
+
+    # Allocate a new job_id and register the job, unless the task runner is full.
+    # Don't wait for task to finish
+    try:
+        job_id = submit_job(webserver.data_parser.batch, data)
+    except AdmissionError as exception:
+        return busy_response(exception)
+
+    webserver.data_parser.logger.info(f"Exiting batch_request with job_id: {job_id}")
+    # Return associated job_id
+    return jsonify({"job_id": job_id})
+
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
     """Gracefully shutdown the server."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     webserver.data_parser.logger.info("Shutting down gracefully")
 
     # Register job. Don't wait for task to finish
@@ -288,11 +404,75 @@ def graceful_shutdown():
     return jsonify({"message": "Shutting down gracefully"}), 200
 
 
+@webserver.route('/api/admin/reload', methods=['POST'])
+def reload_request():
+    """Load a new dataset in the background and swap it in without downtime. The optional
+    csv_path field of the request selects a csv of the dataset directory, by default the
+    current one is reloaded. The request must carry the admin token."""
+    if is_shutdown():
+        return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
+
+    # Only the admins can reload the dataset
+    error = admin_error_response()
+    if error is not None:
+        return error
+
+    # Get request data
+    data = request.get_json(silent=True) or {}
+    try:
+        dataset = reload_dataset_args(data)
+    except ValueError as exception:
+        return jsonify({"status": "error", "reason": str(exception)}), 400
+    webserver.data_parser.logger.info(f"Got request {data} for reload")
+
+    # Only one reload can run at a time
+    with webserver.reload_lock:
+        if webserver.is_reloading:
+            return jsonify({"status": "error", "reason": "Reload already in progress"}), 409
+        webserver.is_reloading = True
+
+    Thread(target=reload_dataset, args=(dataset,), name='reloader', daemon=True).start()
+
+    webserver.data_parser.logger.info("Exiting reload_request")
+    return jsonify({"status": "reloading"}), 202
+
+@webserver.route('/api/admin/append', methods=['POST'])
+def append_request():
+    """Append the rows of the csv chunk in the request body to the dataset."""
+    if is_shutdown():
+        return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
+    webserver.data_parser.logger.info("Entering append_request")
+
+    # Only the admins can change the dataset
+    error = admin_error_response()
+    if error is not None:
+        return error
+
+    # The body is a csv chunk with a header line
+    chunk = request.get_data(as_text=True)
+    try:
+        num_rows = webserver.data_parser.append(io.StringIO(chunk))
+    except ValueError as exception:
+        return jsonify({"status": "error", "reason": str(exception)}), 400
+
+    # The worker processes of the process backend are replaced by ones with the new rows
+    webserver.tasks_runner.append(chunk)
+
+    webserver.data_parser.logger.info(f"Exiting append_request with {num_rows} rows")
+    return jsonify({"status": "done", "rows": num_rows})
+
 @webserver.route('/api/jobs', methods=['GET'])
 def jobs():
-    """Get the status of all jobs."""
+    """Get the status of the jobs, one page at a time. The optional cursor parameter is the
+    job_id to start from, limit is the size of the page and status keeps only those jobs."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     webserver.data_parser.logger.info("Entering get jobs status")
     # Respond with a json with all the job ids and their status
     #  {
@@ -301,27 +481,80 @@ def jobs():
     #       { "job_id_1": "done"},
     #       { "job_id_2": "running"},
     #       { "job_id_3": "running"}
-    #   ]
+    #   ],
+    #      "next_cursor": job_id_4
     #  }
+    cursor = request.args.get('cursor', default=1, type=int)
+    limit = min(request.args.get('limit', default=JOBS_PAGE_SIZE, type=int), MAX_JOBS_PAGE_SIZE)
+    status = request.args.get('status')
+
+    # An empty page would give back the same cursor, and a client following it would loop
+    if limit < 1:
+        return jsonify({"status": "error", "reason": "Invalid limit"}), 400
+
+    page, next_cursor = webserver.data_parser.job_maintainer.jobs(cursor, limit, status)
     jobs_list = []
-    for job_id in range(1, webserver.job_counter):
-        if webserver.data_parser.job_maintainer.is_job_running(job_id):
-            jobs_list.append({job_id: "running"})
-        elif webserver.data_parser.job_maintainer.is_job_done(job_id):
-            jobs_list.append({job_id: "done"})
+    for job_id, job_status in page:
+        jobs_list.append({job_id: job_status})
 
     webserver.data_parser.logger.info("Exiting get jobs status")
-    return jsonify({"status": "done", "data": jobs_list})
+    return jsonify({"status": "done", "data": jobs_list, "next_cursor": next_cursor})
+
+@webserver.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job that is still queued, freeing its place in the queue."""
+    if is_shutdown():
+        return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
+    webserver.data_parser.logger.info(f"Entering cancel_job with job_id: {job_id}")
+
+    if not job_id.isdigit() or not webserver.data_parser.job_maintainer.has_job(int(job_id)):
+        return jsonify({"status": "error", "reason": "Invalid job_id"}), 404
+
+    # Only the queued jobs can be cancelled, a worker may already run the others
+    if not webserver.data_parser.job_maintainer.cancel_job(int(job_id)):
+        job_status = webserver.data_parser.job_maintainer.get_status(int(job_id))
+        return jsonify({"status": "error", "reason": f"Job is {job_status}"}), 409
+    webserver.tasks_runner.discard(int(job_id))
+
+    webserver.data_parser.logger.info(f"Exiting cancel_job with job_id: {job_id}")
+    return jsonify({"status": "cancelled"})
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def num_jobs():
     """Get the number of jobs that have been submitted."""
     if is_shutdown():
         return jsonify({"message": "Server is unable to accept new requests. It is closed."}), 503
+    if not is_ready():
+        return not_ready_response()
     webserver.data_parser.logger.info("Entering get number of jobs")
     webserver.data_parser.logger.info("Exiting get number of jobs")
     # Respond with the number of jobs that have been submitted
-    return jsonify({"num_jobs": webserver.job_counter - 1})
+    return jsonify({"num_jobs": webserver.data_parser.job_maintainer.num_jobs()})
+
+@webserver.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Get the latency histograms of the jobs and the state of the task runner in the
+    Prometheus text format."""
+    body = METRICS.render({
+        'task_queue_depth': webserver.tasks_runner.queue_depth(),
+        'task_active_workers': webserver.tasks_runner.active_workers()
+    })
+    return webserver.response_class(body, mimetype='text/plain; version=0.0.4')
+
+@webserver.route('/api/live', methods=['GET'])
+def live():
+    """Liveness check, the server answers as soon as it starts."""
+    return jsonify({"status": "alive"})
+
+@webserver.route('/api/ready', methods=['GET'])
+def ready():
+    """Readiness check, the server is ready once the dataset and its index are loaded."""
+    if not is_ready():
+        return not_ready_response()
+
+    return jsonify({"status": "ready"})
 
 # You can check localhost in your browser to see what this displays
 @webserver.route('/')
@@ -345,6 +578,124 @@ def get_defined_routes():
         routes.append(f"Endpoint: \"{rule}\" Methods: \"{methods}\"")
     return routes
 
+def sync_deadline():
+    """Get the deadline in seconds of a synchronous request, 0 if the request is asynchronous.
+    It is given by the sync query parameter or by the X-Sync-Deadline header."""
+    deadline = request.args.get('sync', type=float)
+    if deadline is None:
+        deadline = request.headers.get('X-Sync-Deadline', default=0, type=float)
+
+    return min(deadline, MAX_WAIT)
+
+def job_response(job_id):
+    """Respond with the result of the job if it is done before the sync deadline,
+    otherwise with the job_id to poll."""
+    deadline = sync_deadline()
+    if deadline > 0 and webserver.data_parser.job_maintainer.wait_job(job_id, deadline):
+        res = webserver.data_parser.results.get(job_id)
+        if res is not None:
+            # Add the job_id in front of the fields of the stored response
+            return json_bytes_response(b'{"job_id": %d, ' % job_id + res[1:])
+
+    # Fall back to polling when the job did not finish in time
+    return jsonify({"job_id": job_id})
+
+def json_bytes_response(body: bytes):
+    """Respond with JSON that is already serialized"""
+    return webserver.response_class(body, mimetype='application/json')
+
+def job_deadline():
+    """Get the monotonic time after which the job is dropped if it did not start, None if the
+    job has no deadline. It is given in seconds by the deadline query parameter or by the
+    X-Job-Deadline header."""
+    deadline = request.args.get('deadline', type=float)
+    if deadline is None:
+        deadline = request.headers.get('X-Job-Deadline', type=float)
+    if deadline is None:
+        return None
+
+    return time.monotonic() + deadline
+
+def submit_job(execute_job, data):
+    """Allocate a job_id and submit the job with the deadline of the request, raising
+    AdmissionError if the task runner is full. Return the job_id"""
+    return webserver.tasks_runner.try_submit(execute_job, data,
+                                             webserver.data_parser.job_maintainer.new_job,
+                                             job_deadline())
+
+def busy_response(exception):
+    """Respond that the job was rejected, asking the client to retry later"""
+    response = jsonify({"status": "error", "reason": str(exception)})
+    response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response, exception.status
+
+def is_batch_query(query):
+    """Check that a query of a batch has a string endpoint and question, and a string state
+    if it has one"""
+    if not isinstance(query, dict) or 'endpoint' not in query or 'question' not in query:
+        return False
+
+    return all(isinstance(query[field], str) for field in ('endpoint', 'question', 'state')
+               if field in query)
+
+def filter_error_response(data):
+    """Return the error response for a request with invalid filters, None if they are valid"""
+    reason = invalid_filter(data)
+    if reason is None:
+        return None
+
+    return jsonify({"status": "error", "reason": reason}), 400
+
+def admin_error_response():
+    """Return the error response for a request without the admin token, None if it has it"""
+    if ADMIN_TOKEN is None:
+        return jsonify({"status": "error", "reason": "Admin routes are disabled"}), 403
+
+    # Compare in constant time, so the token cannot be guessed from the response times
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({"status": "error", "reason": "Invalid admin token"}), 403
+
+    return None
+
+def reload_dataset_args(data):
+    """Return the DataIngestor arguments of the dataset a reload request selects, raising
+    ValueError if its csv_path is not a csv file of the dataset directory"""
+    if not isinstance(data, dict):
+        raise ValueError("Invalid request")
+
+    dataset = dict(DATASET)
+    if 'csv_path' not in data:
+        return dataset
+
+    csv_path = data['csv_path']
+    if not isinstance(csv_path, str) or not csv_path:
+        raise ValueError("Invalid csv_path")
+
+    # The snapshot is written next to the csv, so the csv must be in the dataset directory.
+    # Resolve the links and the .. of the directory, the csv itself may be a link
+    directory = os.path.realpath(os.path.dirname(os.path.abspath(csv_path)))
+    if directory != os.path.realpath(DATASET_DIR) or not csv_path.endswith('.csv'):
+        raise ValueError("csv_path must be a csv file of the dataset directory")
+
+    dataset['csv_path'] = csv_path
+    if dataset['snapshot_path']:
+        dataset['snapshot_path'] = f"{csv_path}.snapshot"
+    return dataset
+
+def is_ready():
+    """Check if the dataset and its index are loaded."""
+    return webserver.data_parser is not None
+
+def not_ready_response():
+    """Respond with a 503 Service Unavailable telling the client when to retry, or without
+    Retry-After if the dataset failed to load and the server will never be ready."""
+    if webserver.init_error is not None:
+        return jsonify({"status": "error", "reason": webserver.init_error}), 503
+
+    return (jsonify({"status": "loading", "message": "Server is loading the dataset."}), 503,
+            {"Retry-After": str(RETRY_AFTER)})
+
 def is_shutdown():
     """Check if the server is shutdown. If so, respond with a 503 Service Unavailable."""
     if webserver.is_shutdown:
@@ -1,6 +1,65 @@
 """This module contains the ThreadPool class that is responsible for managing the thread pool. """
+import bisect
+import heapq
+import io
+import itertools
 import os
-from concurrent.futures import ThreadPoolExecutor
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Condition, Lock
+from app.data_ingestor import DataIngestor
+from app.data_parser import DataParser, error_envelope
+from app.logger import setup_worker_logger
+from app.metrics import METRICS
+
+# State of a worker process of the process backend, loaded once when the worker starts
+WORKER = {}
+
+class AdmissionError(RuntimeError):
+    """Raised when the task runner cannot take a job, with the HTTP status to answer"""
+    def __init__(self, reason, status):
+        """Initialize the error with its reason and HTTP status"""
+        super().__init__(reason)
+        self.status = status
+
+# Upper bounds in seconds of the estimated run time of the jobs of each priority class, the
+# jobs over the last bound are in the last class
+CLASS_BOUNDS = (0.001, 0.01)
+
+# Estimated run time of the jobs of an endpoint without an initial estimate
+DEFAULT_COST = 0.001
+
+def parse_limits(text):
+    """Parse the per-endpoint limits, written as endpoint=limit,endpoint=limit"""
+    limits = {}
+    for item in text.split(','):
+        if item.strip():
+            endpoint, limit = item.split('=')
+            limits[endpoint.strip()] = int(limit)
+
+    return limits
+
+def _init_worker(dataset, appended=()):
+    """Load the dataset in a worker process of the process backend, with the csv chunks
+    appended to it since it was loaded."""
+    # The worker is forked with the log handlers of the server, which are replaced
+    setup_worker_logger()
+    parser = DataParser(DataIngestor(**dataset))
+    for chunk in appended:
+        parser.append(io.StringIO(chunk))
+    WORKER['parser'] = parser
+
+def _run_in_worker(method_name, params, job_id, submit_time):
+    """Run a parser method in a worker process and return its serialized result, with the
+    time the job waited in the queue and the time it ran."""
+    # The wall clock is shared by the processes, the submit time comes from the parent
+    start = time.time()
+    parser = WORKER['parser']
+    result = getattr(parser, method_name)(params, job_id)
+
+    # The result is kept by the parent process, not by the worker
+    parser.results.delete(job_id)
+    return result, start - submit_time, time.time() - start
 
 def _handle_job_done(job_id, future):
     """Handle the completion of a job."""
@@ -12,28 +71,358 @@ def _handle_job_done(job_id, future):
         # Log the exception
         print(f"Error during execution of job {job_id}: {str(exception)}")
 
+def _handle_process_job_done(parser, job_id, endpoint, future):
+    """Handle the completion of a job run in a worker process."""
+    try:
+        result, queue_wait, duration = future.result()
+    except RuntimeError as exception:
+        # Log the exception
+        print(f"Error during execution of job {job_id}: {str(exception)}")
+        return
+
+    # The stages of the job are timed in the worker, only the totals reach the parent
+    METRICS.observe('job_queue_wait_seconds', queue_wait, endpoint=endpoint)
+    METRICS.observe('job_duration_seconds', duration, endpoint=endpoint)
+
+    # Store the result sent back by the worker in the result store of the parent
+    parser.results.put(job_id, result)
+    parser.job_maintainer.finish_job(job_id)
+
+class AdmissionControl:
+    """Counts of the jobs submitted to the task runner, bounding the queued jobs and the jobs
+    of each endpoint"""
+    def __init__(self, workers, track_active=True, max_queue=None, limits=None):
+        """Initialize the counts for the given number of workers. At most max_queue jobs wait
+        in the queue, TP_MAX_QUEUE by default, and at most limits[endpoint] jobs of an
+        endpoint are queued or running, TP_ENDPOINT_LIMITS by default"""
+        if max_queue is None:
+            max_queue = int(os.environ.get('TP_MAX_QUEUE', 10000))
+        if limits is None:
+            limits = parse_limits(os.environ.get('TP_ENDPOINT_LIMITS', ''))
+
+        self.workers = workers
+        self.max_queue = max_queue
+        self.limits = limits
+
+        # The starts of the jobs run in worker processes are not seen by the parent
+        self.track_active = track_active
+
+        # Jobs submitted that did not finish yet by endpoint, and the ones that started
+        self.lock = Lock()
+        self.pending = {}
+        self.active = 0
+
+    def admit(self, endpoint, enforce=True):
+        """Count a new job of the endpoint, raising AdmissionError if it is over a limit"""
+        with self.lock:
+            if enforce:
+                # A full queue affects every client, a busy endpoint only its callers
+                if self._queue_depth() >= self.max_queue:
+                    raise AdmissionError("Job queue is full", 503)
+                if self.pending.get(endpoint, 0) >= self.limits.get(endpoint, float('inf')):
+                    raise AdmissionError(f"Too many {endpoint} jobs", 429)
+
+            self.pending[endpoint] = self.pending.get(endpoint, 0) + 1
+
+    def start(self):
+        """Count a job as started"""
+        with self.lock:
+            self.active += 1
+
+    def finish(self, endpoint, started=True):
+        """Count a job of the endpoint as finished, or dropped before it started"""
+        with self.lock:
+            self.pending[endpoint] -= 1
+            if started and self.track_active:
+                self.active -= 1
+
+    def _active_workers(self):
+        """Return the number of workers running a job, the lock being held"""
+        # A worker process takes the next job as soon as it is free
+        if not self.track_active:
+            return min(sum(self.pending.values()), self.workers)
+        return self.active
+
+    def _queue_depth(self):
+        """Return the number of jobs that did not start yet, the lock being held"""
+        return sum(self.pending.values()) - self._active_workers()
+
+    def queue_depth(self):
+        """Return the number of jobs that did not start yet"""
+        with self.lock:
+            return self._queue_depth()
+
+    def active_workers(self):
+        """Return the number of workers running a job"""
+        with self.lock:
+            return self._active_workers()
+
+class CostModel:
+    """Estimated run time of the jobs of each endpoint, refined from the measured ones"""
+    def __init__(self, initial=None, smoothing=0.2):
+        """Initialize the estimates, each measure moves them by the smoothing factor"""
+        self.estimates = dict(initial or {})
+        self.smoothing = smoothing
+        self.lock = Lock()
+
+    def estimate(self, endpoint):
+        """Return the estimated run time of a job of the endpoint"""
+        with self.lock:
+            return self.estimates.get(endpoint, DEFAULT_COST)
+
+    def observe(self, endpoint, duration):
+        """Refine the estimate of the endpoint with the measured run time of a job"""
+        with self.lock:
+            estimate = self.estimates.get(endpoint, duration)
+            self.estimates[endpoint] = estimate + self.smoothing * (duration - estimate)
+
+    def priority_class(self, endpoint):
+        """Return the priority class of the jobs of the endpoint, 0 for the shortest"""
+        return bisect.bisect_left(CLASS_BOUNDS, self.estimate(endpoint))
+
+class JobScheduler:
+    """Queue of the jobs waiting for a worker, handing out the short jobs first"""
+    def __init__(self, workers, costs, class_delay=None):
+        """Initialize an empty queue for the given number of workers. A job of priority
+        class c lets the shorter jobs submitted up to c * class_delay seconds after it go
+        first, TP_CLASS_DELAY by default, so the long jobs still run under load"""
+        if class_delay is None:
+            class_delay = float(os.environ.get('TP_CLASS_DELAY', 0.05))
+
+        self.workers = workers
+        self.costs = costs
+        self.class_delay = class_delay
+
+        # Heap of (deadline, sequence, job) and the number of jobs handed to the workers
+        self.queue = []
+        self.sequence = itertools.count()
+        self.running = 0
+        self.idle = Condition()
+
+    def push(self, endpoint, job):
+        """Queue a job of the endpoint and return the jobs to hand to the workers now"""
+        deadline = time.monotonic() + self.costs.priority_class(endpoint) * self.class_delay
+        with self.idle:
+            heapq.heappush(self.queue, (deadline, next(self.sequence), job))
+            return self._take()
+
+    def done(self):
+        """Count a job as finished and return the jobs to hand to the workers now"""
+        with self.idle:
+            self.running -= 1
+            jobs = self._take()
+            if self.running == 0:
+                self.idle.notify_all()
+            return jobs
+
+    def _take(self):
+        """Take the first jobs of the queue for the free workers, the lock being held"""
+        jobs = []
+        while self.queue and self.running < self.workers:
+            jobs.append(heapq.heappop(self.queue)[2])
+            self.running += 1
+
+        return jobs
+
+    def remove(self, job_id):
+        """Remove the job with the given job_id from the queue and return it, None if it is
+        not queued"""
+        with self.idle:
+            for position, (_, _, job) in enumerate(self.queue):
+                if job[2] == job_id:
+                    self.queue[position] = self.queue[-1]
+                    self.queue.pop()
+                    heapq.heapify(self.queue)
+                    if self.running == 0 and not self.queue:
+                        self.idle.notify_all()
+                    return job
+
+        return None
+
+    def wait_idle(self):
+        """Wait until every queued job ran"""
+        with self.idle:
+            self.idle.wait_for(lambda: self.running == 0 and not self.queue)
+
 class ThreadPool:
     """Class to manage the thread pool."""
-    def __init__(self):
-        """Initialize the ThreadPool class."""
+    def __init__(self, backend=None, dataset=None):
+        """Initialize the ThreadPool class. With the process backend every worker process
+        loads the dataset once, when it starts, from the DataIngestor arguments in dataset."""
         if 'TP_NUM_OF_THREADS' in os.environ:
             self.num_threads = int(os.environ['TP_NUM_OF_THREADS'])
         else:
             self.num_threads = os.cpu_count() or 1  # Ensure at least 1 thread
 
-        self.executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        # The backend is either thread or process, selected by TP_BACKEND
+        if backend is None:
+            backend = os.environ.get('TP_BACKEND', 'thread')
+        self.backend = backend
+
+        # Bounds on the jobs waiting in the queue and on the jobs of each endpoint
+        self.admission = AdmissionControl(self.num_threads, track_active=backend != 'process')
+
+        # Jobs wait here for a worker, so the short ones can go ahead of the long ones
+        self.scheduler = JobScheduler(self.num_threads, CostModel(DataParser.job_costs))
+
+        # Dataset of the worker processes and the csv chunks appended to it, replaced under
+        # the lock by the reloads and the appends
+        self.worker_args = (dataset, ())
+        self.workers_lock = Lock()
+
+        if self.backend == 'process':
+            self.executor = self._process_executor()
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_threads)
+
+    def _process_executor(self):
+        """Create a process pool whose workers load the dataset when they start."""
+        return ProcessPoolExecutor(max_workers=self.num_threads, initializer=_init_worker,
+                                   initargs=self.worker_args)
+
+    def _replace_workers(self, update):
+        """Start new worker processes for the new jobs, with the dataset and the appended
+        chunks that update returns from the current ones. The jobs already submitted finish
+        in the old workers."""
+        with self.workers_lock:
+            self.worker_args = update(*self.worker_args)
+            old_executor = self.executor
+            self.executor = self._process_executor()
+        old_executor.shutdown(wait=False)
+
+    def reload(self, dataset):
+        """Load a new dataset in the workers of the process backend. The jobs already
+        submitted finish in the old workers, the new jobs go to the new ones."""
+        if self.backend != 'process':
+            return
+
+        # The chunks appended to the previous dataset are dropped with it
+        self._replace_workers(lambda old_dataset, chunks: (dataset, ()))
+
+    def append(self, chunk):
+        """Append the rows of a csv chunk to the dataset of the workers of the process
+        backend, by starting new workers that load the dataset with every appended chunk. The
+        cost grows with the chunks appended since the last reload."""
+        if self.backend != 'process':
+            return
+
+        self._replace_workers(lambda dataset, chunks: (dataset, chunks + (chunk,)))
+
+    def _run_job(self, execute_job, params, job_id, submit_time):
+        """Run a job in a thread of the pool, timing its wait in the queue and its run."""
+        start = time.time()
+        self.admission.start()
+        endpoint = execute_job.__name__
+        METRICS.observe('job_queue_wait_seconds', start - submit_time, endpoint=endpoint)
+
+        try:
+            return execute_job(params, job_id)
+        finally:
+            METRICS.observe('job_duration_seconds', time.time() - start, endpoint=endpoint)
+            self.admission.finish(endpoint)
+
+    def queue_depth(self):
+        """Return the number of jobs submitted that did not start yet."""
+        return self.admission.queue_depth()
+
+    def active_workers(self):
+        """Return the number of workers running a job."""
+        return self.admission.active_workers()
+
+    def try_submit(self, execute_job, params, new_job, deadline=None):
+        """Allocate a job_id with new_job and submit the job, unless the queue is full or
+        the endpoint has too many jobs. Raise AdmissionError without allocating a job_id
+        when the job is rejected, return the job_id otherwise. A job still queued at the
+        monotonic deadline is dropped."""
+        self.admission.admit(execute_job.__name__)
+        job_id = new_job()
+        self._submit(execute_job, params, job_id, deadline)
+
+        return job_id
 
     def __submit__(self, execute_job, params, job_id):
         """Submit a job to the thread pool."""
+        # The jobs of the parser are claimed when they start, so the ones with an id its job
+        # maintainer does not know yet are registered first
+        parser = getattr(execute_job, '__self__', None)
+        if parser is not None and job_id is not None:
+            parser.job_maintainer.register_job(job_id)
+
+        self.admission.admit(execute_job.__name__, enforce=False)
+        self._submit(execute_job, params, job_id)
+
+    def _submit(self, execute_job, params, job_id, deadline=None):
+        """Queue a job already counted by the admission control."""
+        job = (execute_job, params, job_id, time.time(), deadline)
+        self._dispatch_all(self.scheduler.push(execute_job.__name__, job))
+
+    def discard(self, job_id):
+        """Remove a cancelled job from the queue, freeing its place. Return False if the job
+        is not queued, e.g. a worker already took it."""
+        job = self.scheduler.remove(job_id)
+        if job is None:
+            return False
+
+        self.admission.finish(job[0].__name__, started=False)
+        return True
+
+    def _dispatch_all(self, jobs):
+        """Hand the jobs picked by the scheduler to the workers, replacing the dropped ones."""
+        while jobs:
+            if not self._dispatch(jobs.pop(0)):
+                jobs.extend(self.scheduler.done())
+
+    def _dispatch(self, job):
+        """Hand a job picked by the scheduler to a free worker. Return False if the job was
+        dropped because it was cancelled, it expired or it could not be submitted."""
+        execute_job, params, job_id, submit_time, deadline = job
+        endpoint = execute_job.__name__
+
+        # The jobs of the parser are claimed, so the cancelled and expired ones never run
+        parser = getattr(execute_job, '__self__', None)
+        if (parser is not None and job_id is not None and
+                not parser.job_maintainer.claim_job(job_id, deadline)):
+            self.admission.finish(endpoint, started=False)
+            return False
+
+        start = time.perf_counter()
         try:
-            future = self.executor.submit(execute_job, params, job_id)
+            if self.backend == 'process':
+                # Only the name of the parser method and the request are sent to the worker
+                future = self.executor.submit(_run_in_worker, endpoint, params, job_id,
+                                              submit_time)
+                future.add_done_callback(lambda f: self.admission.finish(endpoint))
+                future.add_done_callback(
+                    lambda f: _handle_process_job_done(parser, job_id, endpoint, f))
+            else:
+                future = self.executor.submit(self._run_job, execute_job, params, job_id,
+                                              submit_time)
 
-            # Add a callback to handle job completion
-            future.add_done_callback(lambda f: _handle_job_done(job_id, f))
+                # Add a callback to handle job completion
+                future.add_done_callback(lambda f: _handle_job_done(job_id, f))
         except RuntimeError as exception:
+            self.admission.finish(endpoint, started=False)
+
             # Log the exception
             print(f"Error submitting job {job_id}: {str(exception)}")
 
+            # The job was claimed, end it so the requests waiting for it get the error
+            if parser is not None and job_id is not None:
+                parser.results.put(job_id, error_envelope(f"Job not submitted: {exception}"))
+                parser.job_maintainer.fail_job(job_id)
+            return False
+
+        # The worker was free, so the job ran from its dispatch to its end
+        future.add_done_callback(lambda f: self._job_done(endpoint, time.perf_counter() - start))
+        return True
+
+    def _job_done(self, endpoint, duration):
+        """Refine the cost of the endpoint and hand the next jobs to the free worker."""
+        self.scheduler.costs.observe(endpoint, duration)
+        self._dispatch_all(self.scheduler.done())
+
     def __shutdown__(self):
         """Shut down the thread pool."""
+        # Run the jobs still waiting in the scheduler before the workers stop
+        self.scheduler.wait_idle()
         self.executor.shutdown(wait=True)
@@ -1,9 +1,32 @@
 """This file contains the unit tests for the server endpoints."""
 import unittest
-from time import sleep
+from unittest import mock
+from time import monotonic, sleep, perf_counter
+from threading import Event, Timer
+import io
 import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pandas as pd
 from app.data_ingestor import DataIngestor
-from app.data_parser import DataParser
+from app import data_parser as data_parser_module
+from app.data_parser import DataParser, category_dict, to_result_dict
+from app.data_index import DataIndex
+from app.result_cache import ResultCache
+from app.result_store import MemoryResultStore
+from app.job_maintainer import JobMaintainer, JobRetention
+from app.task_runner import AdmissionError, CostModel, ThreadPool
+from app.data_snapshot import is_snapshot_valid
+from app.metrics import METRICS, Histogram
+from app.logger import Logger, SILENT_LOGGER, setup_logger, setup_worker_logger, stop_logger
+from app import WEB_SERVER, initialize, routes
+
+def log_in_worker(name, path):
+    """Log a record from a worker process and return the types of the log handlers."""
+    logger = setup_worker_logger(name, path)
+    logger.info("Record from worker")
+    return [type(handler).__name__ for handler in logger.handlers]
 
 class TestServerEndpoints(unittest.TestCase):
     """Class to test the server endpoints."""
@@ -11,6 +34,17 @@ class TestServerEndpoints(unittest.TestCase):
         """Set up the test environment."""
         sleep(1)
 
+    def server_client(self, data_parser):
+        """Return a client of the web server answering from the given parser."""
+        # Wait for the dataset loaded at startup, so it does not replace the parser
+        while WEB_SERVER.data_parser is None and WEB_SERVER.init_error is None:
+            sleep(0.01)
+
+        patcher = mock.patch.object(WEB_SERVER, 'data_parser', data_parser)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return WEB_SERVER.test_client()
+
     def test_global_mean(self):
         """Test the global_mean function."""
         data_ingestor = DataIngestor("./unittests/global_mean/global_mean.csv")
@@ -286,6 +320,927 @@ class TestServerEndpoints(unittest.TestCase):
 
         print("Test worst5 passed successfully.")
 
+    def test_data_index(self):
+        """Test that the data index matches the means computed by filtering the data."""
+        data = DataIngestor("./unit_tests.csv").get()
+        data_index = DataIndex(data)
+
+        # Filter the data in the interval 2011-2022 as the endpoints do
+        data_filtered = data[(data['YearStart'] >= 2011) & (data['YearEnd'] <= 2022)]
+        data_filtered = data_filtered.dropna(subset=['Data_Value'])
+
+        for question, data_question in data_filtered.groupby('Question'):
+            question_index = data_index.get(question)
+
+            # Compare the global mean of the question
+            self.assertAlmostEqual(question_index.global_mean(),
+                                   data_question['Data_Value'].mean(), delta=0.0001,
+                                   msg="Global mean does not match within the expected range")
+
+            # Compare the mean of each state
+            ref_means = data_question.groupby('LocationDesc')['Data_Value'].mean()
+            for state, val in ref_means.items():
+                self.assertAlmostEqual(question_index.summary().state_mean(state), val,
+                                       delta=0.0001,
+                                       msg="State mean does not match within the expected range")
+
+        # Concurrent requests for the same question share a single summary
+        question_index = data_index.get(data_filtered['Question'].iloc[0])
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            summaries = list(executor.map(lambda _: question_index.summary(), range(32)))
+        self.assertTrue(all(summary is summaries[0] for summary in summaries))
+
+        # Unknown questions have no data values
+        self.assertFalse(data_index.has_question("Unknown question"))
+        self.assertEqual(len(data_index.get("Unknown question").states_mean()), 0)
+
+        print("Test data_index passed successfully.")
+
+    def test_compact_ingestion(self):
+        """Test that the compact load mode gives the same results with less memory."""
+        data_ingestor = DataIngestor("./unit_tests.csv")
+        compact_ingestor = DataIngestor("./unit_tests.csv", compact=True)
+
+        # Compact mode keeps fewer columns and stores the strings as categoricals
+        self.assertLess(compact_ingestor.get().memory_usage(deep=True).sum(),
+                        data_ingestor.get().memory_usage(deep=True).sum())
+        self.assertEqual(compact_ingestor.get()['Question'].dtype, 'category')
+
+        # Read input query from in-idx.json
+        with open("./unittests/states_mean/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        # Execute the states_mean function with both load modes
+        result = DataParser(data_ingestor).states_mean(query)
+        compact_result = DataParser(compact_ingestor).states_mean(query)
+
+        data_dict = dict(zip(result['LocationDesc'], result['Data_Value']))
+        compact_dict = dict(zip(compact_result['LocationDesc'], compact_result['Data_Value']))
+
+        # Assert that the keys (LocationDesc) match
+        self.assertEqual(data_dict.keys(), compact_dict.keys(), "LocationDesc does not match")
+
+        for key, val in data_dict.items():
+            self.assertAlmostEqual(val, compact_dict[key], delta=0.0001,
+                                   msg="Data_Value does not match within the expected range")
+
+        print("Test compact_ingestion passed successfully.")
+
+    def test_result_cache(self):
+        """Test that repeated jobs are answered from the result cache."""
+        data_ingestor = DataIngestor("./unittests/best5/best5.csv")
+        data_parser = DataParser(data_ingestor)
+
+        # Read input query from in-idx.json
+        with open("./unittests/best5/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        # Run the same job twice, the second one must be a cache hit
+        data_parser.best5(query, 1)
+        data_parser.best5(dict(reversed(query.items())), 2)
+        self.assertEqual(data_parser.cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+        # Both jobs must have the same result
+        self.assertEqual(data_parser.results.get(1), data_parser.results.get(2))
+        self.assertTrue(data_parser.job_maintainer.is_job_done(2))
+
+        # The least recently used result is evicted when the cache is full
+        cache = ResultCache(max_size=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        cache.get("a")
+        cache.put("c", "3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "1")
+
+        # A result computed before a clear is not put back after it
+        generation = cache.generation
+        cache.clear()
+        cache.put("a", "1", generation)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", "2", cache.generation)
+        self.assertEqual(cache.get("a"), "2")
+
+        print("Test result_cache passed successfully.")
+
+    def test_result_store(self):
+        """Test that the in-memory result store evicts the oldest and expired results."""
+        store = MemoryResultStore(max_size=2, ttl=3600)
+        store.put(1, "1")
+        store.put(2, "2")
+        store.put(3, "3")
+
+        # The oldest result is evicted when the store is full
+        self.assertIsNone(store.get(1))
+        self.assertEqual(store.get(3), "3")
+
+        # Expired results are evicted on access
+        store = MemoryResultStore(max_size=2, ttl=0)
+        store.put(1, "1")
+        self.assertIsNone(store.get(1))
+
+        print("Test result_store passed successfully.")
+
+    def test_wait_job(self):
+        """Test that waiting for a job returns as soon as the job is finished."""
+        job_maintainer = JobMaintainer()
+        job_maintainer.start_job(1)
+
+        # The job is not done before the timeout
+        self.assertFalse(job_maintainer.wait_job(1, 0.01))
+
+        # The waiting request is woken up when the job finishes
+        Timer(0.1, job_maintainer.finish_job, args=[1]).start()
+        self.assertTrue(job_maintainer.wait_job(1, 5))
+        self.assertTrue(job_maintainer.wait_job(1, 0))
+
+        print("Test wait_job passed successfully.")
+
+    def test_job_registry_stress(self):
+        """Stress test the job registry with concurrent submissions."""
+        num_threads = 16
+        jobs_per_thread = 2000
+        job_maintainer = JobMaintainer(JobRetention(max_jobs=num_threads * jobs_per_thread))
+
+        def submit_jobs(_):
+            job_ids = []
+            for _ in range(jobs_per_thread):
+                job_id = job_maintainer.new_job()
+                job_maintainer.start_job(job_id)
+                job_maintainer.finish_job(job_id)
+                job_ids.append(job_id)
+            return job_ids
+
+        # Submit the jobs from many threads at the same time
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(submit_jobs, range(num_threads)))
+        elapsed = perf_counter() - start
+
+        # No job_id is duplicated or lost
+        job_ids = [job_id for job_ids in results for job_id in job_ids]
+        total_jobs = num_threads * jobs_per_thread
+        self.assertEqual(len(set(job_ids)), total_jobs)
+        self.assertEqual(set(job_ids), set(range(1, total_jobs + 1)))
+
+        # Every job is done in the snapshot
+        self.assertEqual(job_maintainer.num_jobs(), total_jobs)
+        page, _ = job_maintainer.jobs(limit=total_jobs)
+        self.assertEqual(len(page), total_jobs)
+        self.assertTrue(all(status == 'done' for _, status in page))
+
+        print(f"Test job_registry_stress passed with {total_jobs / elapsed:.0f} jobs/s.")
+
+    def test_job_retention(self):
+        """Test that old jobs are evicted and the jobs are listed in pages."""
+        evicted = []
+        job_maintainer = JobMaintainer(JobRetention(max_jobs=3, on_evict=evicted.append))
+
+        for _ in range(5):
+            job_id = job_maintainer.new_job()
+            job_maintainer.start_job(job_id)
+            job_maintainer.finish_job(job_id)
+        running_job = job_maintainer.new_job()
+
+        # Only the last 3 finished jobs are retained
+        self.assertEqual(evicted, [1, 2])
+        self.assertFalse(job_maintainer.has_job(1))
+        self.assertEqual(job_maintainer.num_jobs(), 6)
+
+        # Pages follow each other through the cursor
+        page, next_cursor = job_maintainer.jobs(limit=2)
+        self.assertEqual(page, [(3, 'done'), (4, 'done')])
+        page, next_cursor = job_maintainer.jobs(next_cursor, limit=2)
+        self.assertEqual(page, [(5, 'done'), (running_job, 'queued')])
+        page, next_cursor = job_maintainer.jobs(next_cursor, limit=2)
+        self.assertEqual((page, next_cursor), ([], None))
+
+        # Jobs can be filtered by status
+        page, next_cursor = job_maintainer.jobs(status='queued')
+        self.assertEqual((page, next_cursor), ([(running_job, 'queued')], None))
+
+        # A filtered page scans a bounded number of job ids and returns the cursor it reached
+        job_maintainer = JobMaintainer(JobRetention(max_jobs=100))
+        for _ in range(25):
+            job_id = job_maintainer.new_job()
+            job_maintainer.start_job(job_id)
+            job_maintainer.finish_job(job_id)
+        queued_job = job_maintainer.new_job()
+        self.assertEqual(job_maintainer.jobs(limit=1, status='queued'), ([], 11))
+        self.assertEqual(job_maintainer.jobs(11, limit=1, status='queued'), ([], 21))
+        self.assertEqual(job_maintainer.jobs(21, limit=1, status='queued'),
+                         ([(queued_job, 'queued')], queued_job + 1))
+
+        # An empty page is never returned for a limit under 1, and the route rejects it
+        self.assertEqual(job_maintainer.jobs(limit=0), ([(1, 'done')], 2))
+        client = self.server_client(DataParser(DataIngestor("./unittests/best5/best5.csv")))
+        self.assertEqual(client.get('/api/jobs?limit=0').status_code, 400)
+        self.assertEqual(client.get('/api/jobs?limit=-5').status_code, 400)
+
+        print("Test job_retention passed successfully.")
+
+    def test_batch(self):
+        """Test that a batch gives the same answers as the separate queries."""
+        data_ingestor = DataIngestor("./unittests/state_mean/state_mean.csv")
+        data_parser = DataParser(data_ingestor)
+
+        # Read input query from in-idx.json
+        with open("./unittests/state_mean/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        batch = [
+            {"endpoint": "state_mean", **query},
+            {"endpoint": "global_mean", "question": query['question']},
+            {"endpoint": "state_mean", "question": query['question']},
+            {"endpoint": "unknown", "question": query['question']}
+        ]
+        answers = data_parser.batch(batch)
+
+        # Answers are in the order of the queries
+        state_mean = data_parser.state_mean(query)
+        self.assertEqual(answers[0]['data'],
+                         dict(zip(state_mean['LocationDesc'], state_mean['Data_Value'])))
+        self.assertEqual(answers[1]['data'],
+                         {"global_mean": data_parser.global_mean(query)['Data_Value'].item()})
+
+        # Invalid queries are reported without failing the whole batch
+        self.assertEqual(answers[2]['error'], "Missing state")
+        self.assertEqual(answers[3]['error'], "Invalid endpoint")
+
+        # Queries with fields that are not strings are rejected before they reach a worker
+        client = self.server_client(data_parser)
+        for invalid in ({"endpoint": "state_mean", "question": ["a"]},
+                        {"endpoint": 1, "question": query['question']},
+                        {"endpoint": "state_mean", **query, "state": ["a"]}):
+            response = client.post('/api/batch', json=batch[:2] + [invalid])
+            self.assertEqual(response.status_code, 400, invalid)
+        self.assertIn('job_id', client.post('/api/batch', json=batch).get_json())
+
+        print("Test batch passed successfully.")
+
+    def test_category_dict_benchmark(self):
+        """Benchmark the vectorized category keys against the row by row loop."""
+        data_ingestor = DataIngestor("./unittests/mean_by_category/mean_by_category.csv")
+        data_parser = DataParser(data_ingestor)
+
+        # Read input query from in-idx.json
+        with open("./unittests/mean_by_category/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        # Repeat the means of the question to the size of the full dataset
+        data_mean = data_parser.index.get(query['question']).categories_mean()
+        data_mean = pd.concat([data_mean] * (5000 // len(data_mean) + 1), ignore_index=True)
+        data_mean['LocationDesc'] = (data_mean['LocationDesc'].astype(str) +
+                                     data_mean.index.astype(str))
+        columns = ['LocationDesc', 'StratificationCategory1', 'Stratification1']
+
+        # Build the dictionary row by row, as it was done before
+        start = perf_counter()
+        ref_result = {}
+        for _, row in data_mean.iterrows():
+            key = (
+                f"('{row['LocationDesc']}', '{row['StratificationCategory1']}', "
+                f"'{row['Stratification1']}')"
+            )
+            ref_result[key] = row['Data_Value']
+        loop_time = perf_counter() - start
+
+        # Build the dictionary column by column
+        start = perf_counter()
+        result = category_dict(data_mean, columns)
+        vectorized_time = perf_counter() - start
+
+        self.assertEqual(result, ref_result)
+        self.assertLess(vectorized_time, loop_time)
+
+        print(f"Test category_dict_benchmark passed with a {loop_time / vectorized_time:.1f}x "
+              f"speedup on {len(data_mean)} rows.")
+
+    def test_process_backend(self):
+        """Test that jobs run in worker processes send their results to the parent."""
+        data_ingestor = DataIngestor("./unittests/best5/best5.csv")
+        data_parser = DataParser(data_ingestor)
+        tasks_runner = ThreadPool(backend='process',
+                                  dataset={"csv_path": "./unittests/best5/best5.csv"})
+
+        # Read input query from in-idx.json
+        with open("./unittests/best5/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        # Read ref results from out-idx.json
+        with open("./unittests/best5/output/out-1.json", "r", encoding="utf-8") as fout:
+            ref_result = json.load(fout)
+
+        # Run the job in a worker process and wait for it in the parent
+        job_id = data_parser.job_maintainer.new_job()
+        tasks_runner.__submit__(data_parser.best5, query, job_id)
+        self.assertTrue(data_parser.job_maintainer.wait_job(job_id, 60))
+
+        result = json.loads(data_parser.results.get(job_id))['data']
+        self.assertEqual(result.keys(), ref_result.keys(), "LocationDesc does not match")
+        for key, val in result.items():
+            self.assertAlmostEqual(val, ref_result[key], delta=0.0001,
+                                   msg="Data_Value does not match within the expected range")
+
+        # Rows appended in the parent reach the workers of the next jobs
+        state = next(iter(result))
+        rows = data_ingestor.get().head(3).assign(Question=query["question"], LocationDesc=state,
+                                                 Data_Value=1000.0)
+        chunk = rows.to_csv(index=False)
+        data_parser.append(io.StringIO(chunk))
+        tasks_runner.append(chunk)
+
+        job_id = data_parser.job_maintainer.new_job()
+        tasks_runner.__submit__(data_parser.state_mean, {**query, "state": state}, job_id)
+        self.assertTrue(data_parser.job_maintainer.wait_job(job_id, 60))
+        tasks_runner.__shutdown__()
+
+        expected = data_parser.state_mean({**query, "state": state})['Data_Value'].item()
+        self.assertNotAlmostEqual(expected, result[state], delta=0.0001)
+        self.assertAlmostEqual(json.loads(data_parser.results.get(job_id))['data'][state],
+                               expected, delta=0.0001)
+
+        print("Test process_backend passed successfully.")
+
+    def test_snapshot(self):
+        """Test that the memory-mapped snapshot gives the same results as the csv."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, "states_mean.snapshot")
+            data_ingestor = DataIngestor("./unittests/states_mean/states_mean.csv", compact=True)
+            snapshot_ingestor = DataIngestor("./unittests/states_mean/states_mean.csv",
+                                             snapshot_path=snapshot_path)
+
+            # The snapshot is created once and its data is the compact data of the csv
+            self.assertTrue(os.path.isdir(snapshot_path))
+            self.assertTrue(snapshot_ingestor.get().equals(data_ingestor.get()))
+
+            # Read input query from in-idx.json
+            with open("./unittests/states_mean/input/in-1.json", "r", encoding="utf-8") as fin:
+                query = json.load(fin)
+
+            # Read ref results from out-idx.json
+            with open("./unittests/states_mean/output/out-1.json", "r",
+                      encoding="utf-8") as fout:
+                ref_result = json.load(fout)
+
+            result = DataParser(snapshot_ingestor).states_mean(query)
+            data_dict = dict(zip(result['LocationDesc'], result['Data_Value']))
+
+            # Assert that the keys (LocationDesc) match
+            self.assertEqual(data_dict.keys(), ref_result.keys(), "LocationDesc does not match")
+            for key, val in data_dict.items():
+                self.assertAlmostEqual(val, ref_result[key], delta=0.0001,
+                                       msg="Data_Value does not match within the expected range")
+
+        print("Test snapshot passed successfully.")
+
+    def test_snapshot_validation(self):
+        """Test that the snapshot is reused until the csv changes."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "best5.csv")
+            snapshot_path = f"{csv_path}.snapshot"
+            data = pd.read_csv("./unittests/best5/best5.csv")
+            data.to_csv(csv_path, index=False)
+
+            # The first boot reads the csv, the next one loads the snapshot
+            self.assertEqual(DataIngestor(csv_path, snapshot_path=snapshot_path).source, "csv")
+            self.assertEqual(DataIngestor(csv_path, snapshot_path=snapshot_path).source,
+                             "snapshot")
+
+            # A changed csv invalidates the snapshot
+            data.head(5).to_csv(csv_path, index=False)
+            self.assertFalse(is_snapshot_valid(snapshot_path, csv_path))
+            data_ingestor = DataIngestor(csv_path, snapshot_path=snapshot_path)
+            self.assertEqual(data_ingestor.source, "csv")
+            self.assertEqual(len(data_ingestor.get()), 5)
+
+            # A damaged snapshot of the current csv is deleted and rebuilt from the csv
+            meta_path = os.path.join(snapshot_path, "meta.json")
+            with open(meta_path, "r", encoding="utf-8") as fin:
+                meta = json.load(fin)
+            damaged_metas = ("{", json.dumps({"source": meta['source']}),
+                             json.dumps({**meta, "columns": meta['columns'][:2]}))
+            for damaged_meta in damaged_metas:
+                with open(meta_path, "w", encoding="utf-8") as fout:
+                    fout.write(damaged_meta)
+                data_ingestor = DataIngestor(csv_path, snapshot_path=snapshot_path)
+                self.assertEqual(data_ingestor.source, "csv")
+                self.assertEqual(len(data_ingestor.get()), 5)
+                self.assertEqual(DataIngestor(csv_path, snapshot_path=snapshot_path).source,
+                                 "snapshot")
+
+            # So is a snapshot with a truncated array
+            with open(os.path.join(snapshot_path, "0.npy"), "r+b") as fout:
+                fout.truncate(100)
+            self.assertEqual(DataIngestor(csv_path, snapshot_path=snapshot_path).source, "csv")
+            self.assertEqual(DataIngestor(csv_path, snapshot_path=snapshot_path).source,
+                             "snapshot")
+
+        print("Test snapshot_validation passed successfully.")
+
+    def test_reload_keeps_jobs(self):
+        """Test that a parser of a new dataset keeps the jobs of the previous one."""
+        old_parser = DataParser(DataIngestor("./unittests/best5/best5.csv"))
+        new_parser = DataParser(DataIngestor("./unittests/worst5/worst5.csv"),
+                                old_parser.job_maintainer, old_parser.results)
+        new_parser.index.warm_up()
+
+        # Read input query from in-idx.json
+        with open("./unittests/best5/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        # A job of the old dataset is still visible through the new parser
+        job_id = old_parser.job_maintainer.new_job()
+        old_parser.best5(query, job_id)
+        self.assertTrue(new_parser.job_maintainer.is_job_done(job_id))
+        self.assertEqual(new_parser.results.get(job_id), old_parser.results.get(job_id))
+
+        # New jobs get the next job_id and the data of the new dataset
+        new_job_id = new_parser.job_maintainer.new_job()
+        self.assertEqual(new_job_id, job_id + 1)
+        new_parser.worst5(query, new_job_id)
+        self.assertEqual(json.loads(new_parser.results.get(new_job_id))['data'],
+                         to_result_dict('worst5', query, new_parser.worst5(query)))
+
+        print("Test reload_keeps_jobs passed successfully.")
+
+    def test_append(self):
+        """Test that appending rows gives the results of a parser built on all the rows."""
+        data = pd.read_csv("./unit_tests.csv")
+        half = len(data) // 2
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "first.csv")
+            data.iloc[:half].to_csv(csv_path, index=False)
+            data_parser = DataParser(DataIngestor(csv_path, compact=True))
+            full_parser = DataParser(DataIngestor("./unit_tests.csv", compact=True))
+
+            # Cache a result that the appended rows make stale
+            question = data['Question'].iloc[-1]
+            data_parser.states_mean({"question": question})
+
+            chunk_path = os.path.join(tmp_dir, "chunk.csv")
+            data.iloc[half:].to_csv(chunk_path, index=False)
+            self.assertEqual(data_parser.append(chunk_path), len(data) - half)
+            self.assertEqual(len(data_parser.data), len(data))
+
+        # The appended index gives the same means as the one built on all the rows
+        for question in data['Question'].unique():
+            query = {"question": question}
+            self.assertEqual(data_parser.states_mean(query).to_dict(),
+                             full_parser.states_mean(query).to_dict())
+            self.assertEqual(data_parser.state_mean_by_category({**query, "state": "Ohio"}),
+                             full_parser.state_mean_by_category({**query, "state": "Ohio"}))
+            self.assertAlmostEqual(data_parser.index.get(question).global_mean(),
+                                   full_parser.index.get(question).global_mean(), delta=0.0001)
+
+        # A chunk without the columns of the data or without rows is rejected
+        with self.assertRaises(ValueError):
+            data_parser.append(io.StringIO("YearStart,YearEnd\n2015,2015\n"))
+        with self.assertRaises(ValueError):
+            data_parser.append(io.StringIO(",".join(data.columns) + "\n"))
+        self.assertEqual(len(data_parser.data), len(data))
+
+        # A categorical column left empty in the chunk is read as floats, and still appended
+        rows = data.head(2).assign(StratificationCategory1=None, Stratification1=None)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, "data.snapshot")
+            for data_ingestor in (DataIngestor("./unit_tests.csv", compact=True),
+                                  DataIngestor("./unit_tests.csv", snapshot_path=snapshot_path)):
+                data_parser = DataParser(data_ingestor)
+                self.assertEqual(data_parser.append(io.StringIO(rows.to_csv(index=False))), 2)
+                self.assertEqual(data_parser.data['Stratification1'].tail(2).isna().sum(), 2)
+                self.assertIsInstance(data_parser.data['Stratification1'].dtype,
+                                      pd.CategoricalDtype)
+
+        # The route answers 400 for a chunk without rows
+        client = self.server_client(data_parser)
+        with mock.patch.object(routes, 'ADMIN_TOKEN', 'secret'):
+            response = client.post('/api/admin/append', data=",".join(data.columns) + "\n",
+                                   headers={'X-Admin-Token': 'secret'})
+        self.assertEqual(response.status_code, 400)
+
+        print("Test append passed successfully.")
+
+    def test_streaming(self):
+        """Test that a dataset streamed in chunks gives the results of the loaded one."""
+        full_parser = DataParser(DataIngestor("./unit_tests.csv", compact=True))
+        data_ingestor = DataIngestor("./unit_tests.csv", chunk_size=7)
+        data_parser = DataParser(data_ingestor)
+
+        # Only the sums and counts are kept, not the rows
+        self.assertEqual(data_ingestor.source, "stream")
+        self.assertIsNone(data_parser.data)
+
+        for question in full_parser.data['Question'].unique():
+            query = {"question": question}
+            self.assertEqual(data_parser.states_mean(query).to_dict(),
+                             full_parser.states_mean(query).to_dict())
+            self.assertEqual(data_parser.mean_by_category(query),
+                             full_parser.mean_by_category(query))
+            self.assertAlmostEqual(data_parser.index.get(question).global_mean(),
+                                   full_parser.index.get(question).global_mean(), delta=0.0001)
+
+        # Rows appended in streaming mode go to the index only
+        data_parser.append("./unittests/best5/best5.csv")
+        self.assertIsNone(data_parser.data)
+
+        print("Test streaming passed successfully.")
+
+    def test_query_filter(self):
+        """Test that the year window and stratification filters match filtering the data."""
+        data_parser = DataParser(DataIngestor("./unit_tests.csv", compact=True))
+        data = data_parser.data.dropna(subset=['Data_Value'])
+        question = data['Question'].iloc[0]
+
+        # Without filters the default interval 2011-2022 is used
+        query = {"question": question}
+        self.assertEqual(data_parser.states_mean(query).to_dict(),
+                         data_parser.states_mean({**query, "year_start": 2011,
+                                                  "year_end": 2022}).to_dict())
+
+        for year_start, year_end, category in [(2015, 2016, None), (2011, 2022, "Gender"),
+                                               (2013, 2020, "Income")]:
+            query = {"question": question, "year_start": year_start, "year_end": year_end}
+            data_filtered = data[(data['Question'] == question) &
+                                 (data['YearStart'] >= year_start) &
+                                 (data['YearEnd'] <= year_end)]
+            if category is not None:
+                query['stratification_category'] = category
+                data_filtered = data_filtered[data_filtered['StratificationCategory1'] == category]
+
+            # Compare the mean of each state
+            ref_means = data_filtered.groupby('LocationDesc', observed=True)['Data_Value'].mean()
+            result = data_parser.states_mean(query)
+            result = dict(zip(result['LocationDesc'], result['Data_Value']))
+            self.assertEqual(set(result), set(ref_means.index))
+            for state, val in ref_means.items():
+                self.assertAlmostEqual(result[state], val, delta=0.0001,
+                                       msg="State mean does not match within the expected range")
+
+            # A filtered index is built once and reused
+            self.assertIs(data_parser.question_index(query), data_parser.question_index(query))
+
+        # Invalid filters are reported by the batch queries
+        answers = data_parser.batch([{"endpoint": "global_mean", "question": question,
+                                      "year_start": 2020, "year_end": 2015},
+                                     {"endpoint": "global_mean", "question": question,
+                                      "year_start": "2015"}])
+        self.assertEqual([answer['error'] for answer in answers],
+                         ["Invalid year window", "Invalid year_start"])
+
+        print("Test query_filter passed successfully.")
+
+    def test_preserialized_results(self):
+        """Test that the results are stored as the bytes of the response of a finished job."""
+        data_parser = DataParser(DataIngestor("./unittests/states_mean/states_mean.csv"))
+
+        # Read input query from in-idx.json
+        with open("./unittests/states_mean/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        job_id = data_parser.job_maintainer.new_job()
+        data_parser.states_mean(query, job_id)
+        result = data_parser.results.get(job_id)
+        self.assertIsInstance(result, bytes)
+        self.assertEqual(json.loads(result),
+                         {"status": "done",
+                          "data": to_result_dict('states_mean', query,
+                                                 data_parser.states_mean(query))})
+
+        # The optional encoder gives the same response
+        if data_parser_module.orjson is not None:
+            data_parser_module.JSON_ENCODER = 'orjson'
+            try:
+                data_parser.cache.clear()
+                job_id = data_parser.job_maintainer.new_job()
+                self.assertEqual(json.loads(data_parser.states_mean(query, job_id)),
+                                 json.loads(result))
+            finally:
+                data_parser_module.JSON_ENCODER = 'json'
+
+        print("Test preserialized_results passed successfully.")
+
+    def test_metrics(self):
+        """Test that the jobs are timed in histograms rendered in the Prometheus format."""
+        # Every value is counted in the first bucket whose upper bound is not below it
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.render('latency', (('stage', 'index'),)), [
+            'latency_bucket{stage="index",le="0.1"} 2',
+            'latency_bucket{stage="index",le="1.0"} 3',
+            'latency_bucket{stage="index",le="+Inf"} 4',
+            'latency_sum{stage="index"} 2.65',
+            'latency_count{stage="index"} 4'
+        ])
+
+        METRICS.clear()
+        data_parser = DataParser(DataIngestor("./unittests/best5/best5.csv"))
+        tasks_runner = ThreadPool(backend='thread')
+
+        # Read input query from in-idx.json
+        with open("./unittests/best5/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        job_id = data_parser.job_maintainer.new_job()
+        tasks_runner.__submit__(data_parser.best5, query, job_id)
+        self.assertTrue(data_parser.job_maintainer.wait_job(job_id, 10))
+        tasks_runner.__shutdown__()
+
+        # The wait in the queue, the run and every stage of the job are counted
+        text = METRICS.render({'task_queue_depth': tasks_runner.queue_depth(),
+                               'task_active_workers': tasks_runner.active_workers()})
+        for line in ['# TYPE job_queue_wait_seconds histogram',
+                     'job_queue_wait_seconds_count{endpoint="best5"} 1',
+                     'job_duration_seconds_count{endpoint="best5"} 1',
+                     'job_stage_seconds_count{stage="index"} 1',
+                     'job_stage_seconds_count{stage="serialize"} 1',
+                     'job_stage_seconds_count{stage="write"} 1',
+                     '# TYPE task_queue_depth gauge',
+                     'task_queue_depth 0',
+                     'task_active_workers 0']:
+            self.assertIn(line, text.splitlines())
+
+        # The long-poll wait of get_results is not counted in its latency
+        client = self.server_client(data_parser)
+        queued_job = data_parser.job_maintainer.new_job()
+        response = client.get(f"/api/get_results/{queued_job}?wait=0.5")
+        self.assertEqual(response.get_json(), {"status": "running"})
+        self.assertLess(METRICS.histograms['result_fetch_seconds'][()].total, 0.5)
+
+        print("Test metrics passed successfully.")
+
+    def test_async_logging(self):
+        """Test that the asynchronous logger writes every record from its own thread."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "async.log")
+            logger = setup_logger(name="AsyncTestLogger", path=log_path, asynchronous=True)
+
+            # The records are only enqueued by the threads that log them
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda i: logger.info("Record %d", i), range(200)))
+            stop_logger("AsyncTestLogger")
+
+            with open(log_path, "r", encoding="utf-8") as fin:
+                lines = fin.read().splitlines()
+            self.assertEqual(len(lines), 200)
+            self.assertEqual({line.split("Record ")[1] for line in lines},
+                             {str(i) for i in range(200)})
+
+            # A worker forked from an asynchronous logger writes its records synchronously
+            logger = setup_logger(name="ForkTestLogger", path=log_path, asynchronous=True)
+            worker_path = os.path.join(tmp_dir, "worker.log")
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                self.assertEqual(executor.submit(log_in_worker, "ForkTestLogger",
+                                                 worker_path).result(), ['RotatingFileHandler'])
+            stop_logger("ForkTestLogger")
+            with open(worker_path, "r", encoding="utf-8") as fin:
+                self.assertIn("Record from worker", fin.read())
+
+        # Only one in sample_rate of the sampled requests is logged
+        logger = Logger(sample_rate=4)
+        sampled = [logger.sampled() for _ in range(8)]
+        self.assertEqual([item is logger for item in sampled], [True, False, False, False] * 2)
+        self.assertTrue(all(item is SILENT_LOGGER for item in sampled if item is not logger))
+
+        print("Test async_logging passed successfully.")
+
+    def test_admission_control(self):
+        """Test that the task runner rejects jobs over the queue depth and endpoint limits."""
+        job_maintainer = JobMaintainer()
+        release = Event()
+
+        def slow(params, job_id):
+            """Job that runs until it is released."""
+            release.wait(10)
+
+        def cheap(params, job_id):
+            """Job that finishes right away."""
+
+        # A single worker, two queued jobs and one slow job at most
+        with mock.patch.dict(os.environ, {'TP_NUM_OF_THREADS': '1', 'TP_MAX_QUEUE': '2',
+                                          'TP_ENDPOINT_LIMITS': 'slow=1'}):
+            tasks_runner = ThreadPool(backend='thread')
+
+        # The only worker runs the slow job, a second one is over the limit of the endpoint
+        self.assertEqual(tasks_runner.try_submit(slow, {}, job_maintainer.new_job), 1)
+        while tasks_runner.active_workers() < 1:
+            sleep(0.01)
+        with self.assertRaises(AdmissionError) as context:
+            tasks_runner.try_submit(slow, {}, job_maintainer.new_job)
+        self.assertEqual(context.exception.status, 429)
+
+        # The other endpoints queue up to the depth of the queue
+        tasks_runner.try_submit(cheap, {}, job_maintainer.new_job)
+        tasks_runner.try_submit(cheap, {}, job_maintainer.new_job)
+        self.assertEqual(tasks_runner.queue_depth(), 2)
+        with self.assertRaises(AdmissionError) as context:
+            tasks_runner.try_submit(cheap, {}, job_maintainer.new_job)
+        self.assertEqual(context.exception.status, 503)
+
+        # Rejected jobs get no job_id, and the counts drop once the jobs finish
+        self.assertEqual(job_maintainer.num_jobs(), 3)
+        release.set()
+        tasks_runner.__shutdown__()
+        self.assertEqual((tasks_runner.queue_depth(), tasks_runner.active_workers()), (0, 0))
+
+        print("Test admission_control passed successfully.")
+
+    def test_priority_scheduling(self):
+        """Test that short jobs are scheduled ahead of long ones and the costs are refined."""
+        release = Event()
+        order = []
+
+        def state_mean(params, job_id):
+            """Short job that records when it ran."""
+            order.append(job_id)
+
+        def mean_by_category(params, job_id):
+            """Long job that runs until it is released, then records when it ran."""
+            release.wait(10)
+            order.append(job_id)
+
+        with mock.patch.dict(os.environ, {'TP_NUM_OF_THREADS': '1', 'TP_CLASS_DELAY': '10'}):
+            tasks_runner = ThreadPool(backend='thread')
+
+        # The only worker is busy, the long job is queued before the short ones
+        tasks_runner.__submit__(mean_by_category, {}, 1)
+        while tasks_runner.active_workers() < 1:
+            sleep(0.01)
+        tasks_runner.__submit__(mean_by_category, {}, 2)
+        tasks_runner.__submit__(state_mean, {}, 3)
+        tasks_runner.__submit__(state_mean, {}, 4)
+        self.assertEqual(tasks_runner.queue_depth(), 3)
+        release.set()
+        tasks_runner.__shutdown__()
+        self.assertEqual(order, [1, 3, 4, 2])
+
+        # The estimates move towards the measured run times
+        costs = CostModel({'state_mean': 0.0002}, smoothing=0.5)
+        self.assertEqual(costs.priority_class('state_mean'), 0)
+        costs.observe('state_mean', 0.1)
+        costs.observe('state_mean', 0.1)
+        self.assertAlmostEqual(costs.estimate('state_mean'), 0.07505)
+        self.assertEqual(costs.priority_class('state_mean'), 2)
+
+        print("Test priority_scheduling passed successfully.")
+
+    def test_cancel_and_deadline(self):
+        """Test that cancelled and expired jobs are dropped before they run."""
+        data_parser = DataParser(DataIngestor("./unittests/best5/best5.csv"))
+        job_maintainer = data_parser.job_maintainer
+        release = Event()
+
+        def slow(params, job_id):
+            """Job that keeps the only worker busy until it is released."""
+            release.wait(10)
+
+        # Read input query from in-idx.json
+        with open("./unittests/best5/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+
+        with mock.patch.dict(os.environ, {'TP_NUM_OF_THREADS': '1'}):
+            tasks_runner = ThreadPool(backend='thread')
+        tasks_runner.__submit__(slow, {}, 0)
+        while tasks_runner.active_workers() < 1:
+            sleep(0.01)
+
+        # Three jobs wait for the worker, one cancelled and one past its deadline
+        cancelled = tasks_runner.try_submit(data_parser.best5, query, job_maintainer.new_job)
+        expired = tasks_runner.try_submit(data_parser.worst5, query, job_maintainer.new_job,
+                                          monotonic())
+        done = tasks_runner.try_submit(data_parser.states_mean, query, job_maintainer.new_job,
+                                       monotonic() + 60)
+        self.assertTrue(job_maintainer.cancel_job(cancelled))
+        self.assertTrue(tasks_runner.discard(cancelled))
+        self.assertEqual(tasks_runner.queue_depth(), 2)
+
+        # Waiting for a cancelled job ends right away
+        self.assertFalse(job_maintainer.wait_job(cancelled, 10))
+
+        release.set()
+        self.assertTrue(job_maintainer.wait_job(done, 10))
+        tasks_runner.__shutdown__()
+
+        self.assertEqual([job_maintainer.get_status(job_id)
+                          for job_id in (cancelled, expired, done)],
+                         ['cancelled', 'expired', 'done'])
+        self.assertIsNone(data_parser.results.get(cancelled))
+        self.assertIsNone(data_parser.results.get(expired))
+
+        # Jobs that started cannot be cancelled
+        self.assertFalse(job_maintainer.cancel_job(done))
+        self.assertEqual(job_maintainer.jobs(status='expired')[0], [(expired, 'expired')])
+
+        # Jobs submitted directly with their own job_id still run
+        with mock.patch.dict(os.environ, {'TP_NUM_OF_THREADS': '1'}):
+            tasks_runner = ThreadPool(backend='thread')
+        tasks_runner.__submit__(data_parser.best5, query, 100)
+        self.assertTrue(job_maintainer.wait_job(100, 10))
+        tasks_runner.__shutdown__()
+        self.assertEqual(json.loads(data_parser.results.get(100))['data'],
+                         to_result_dict('best5', query, data_parser.best5(query)))
+
+        # A claimed job that the workers cannot take fails and its waiters are woken up
+        failed = tasks_runner.try_submit(data_parser.worst5, query, job_maintainer.new_job)
+        self.assertFalse(job_maintainer.wait_job(failed, 0))
+        self.assertEqual(job_maintainer.get_status(failed), 'failed')
+        self.assertEqual(json.loads(data_parser.results.get(failed))['status'], 'error')
+        self.assertEqual(tasks_runner.queue_depth(), 0)
+
+        print("Test cancel_and_deadline passed successfully.")
+
+    def test_admin_reload(self):
+        """Test that a reload needs the admin token and a csv of the dataset directory."""
+        client = self.server_client(DataParser(DataIngestor("./unittests/best5/best5.csv")))
+
+        # The admin routes are disabled without a token, and need the right one
+        response = client.post('/api/admin/reload', json={})
+        self.assertEqual(response.status_code, 403)
+        response = client.post('/api/admin/append', data="YearStart\n2015\n")
+        self.assertEqual(response.status_code, 403)
+        with mock.patch.object(routes, 'ADMIN_TOKEN', 'secret'):
+            response = client.post('/api/admin/reload', json={},
+                                   headers={'X-Admin-Token': 'guess'})
+            self.assertEqual(response.status_code, 403)
+
+            # Only the csv files of the dataset directory can be loaded
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                outside = os.path.join(tmp_dir, "other.csv")
+                for csv_path in (None, ["a.csv"], outside, "../other.csv", "requests.jsonl"):
+                    response = client.post('/api/admin/reload', json={"csv_path": csv_path},
+                                           headers={'X-Admin-Token': 'secret'})
+                    self.assertEqual(response.status_code, 400, csv_path)
+                self.assertEqual(os.listdir(tmp_dir), [])
+
+            # A csv of the dataset directory is loaded in the background
+            with mock.patch.object(routes, 'Thread') as thread:
+                response = client.post('/api/admin/reload', json={"csv_path": "unit_tests.csv"},
+                                       headers={'X-Admin-Token': 'secret'})
+            WEB_SERVER.is_reloading = False
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(thread.call_args.kwargs['args'][0]['csv_path'], "unit_tests.csv")
+
+        print("Test admin_reload passed successfully.")
+
+    def test_sync_response(self):
+        """Test that synchronous requests get the result in the response, or the job_id."""
+        data_parser = DataParser(DataIngestor("./unittests/state_mean/state_mean.csv"))
+        client = self.server_client(data_parser)
+
+        # Read input query from in-idx.json
+        with open("./unittests/state_mean/input/in-1.json", "r", encoding="utf-8") as fin:
+            query = json.load(fin)
+        expected = to_result_dict('state_mean', query, data_parser.state_mean(query))
+
+        # The deadline is given by the sync parameter or by the X-Sync-Deadline header
+        for response in (client.post('/api/state_mean?sync=10', json=query),
+                         client.post('/api/state_mean', json=query,
+                                     headers={'X-Sync-Deadline': '10'})):
+            result = response.get_json()
+            self.assertEqual(set(result), {"job_id", "status", "data"})
+            self.assertEqual((result['status'], result['data']), ("done", expected))
+            self.assertEqual(client.get(f"/api/get_results/{result['job_id']}").get_json(),
+                             {"status": "done", "data": expected})
+
+        # Asynchronous requests and the ones past their deadline only get the job_id
+        self.assertEqual(set(client.post('/api/state_mean', json=query).get_json()), {"job_id"})
+        with mock.patch.object(data_parser.job_maintainer, 'wait_job', return_value=False):
+            result = client.post('/api/state_mean?sync=0.01', json=query).get_json()
+        self.assertEqual(set(result), {"job_id"})
+        self.assertTrue(data_parser.job_maintainer.wait_job(result['job_id'], 10))
+
+        print("Test sync_response passed successfully.")
+
+    def test_readiness(self):
+        """Test the liveness and readiness checks while loading, once ready and on failure."""
+        client = self.server_client(None)
+        self.assertEqual(client.get('/api/live').get_json(), {"status": "alive"})
+
+        # While the dataset is loading the clients are told to retry
+        with mock.patch.object(WEB_SERVER, 'init_error', None):
+            for response in (client.get('/api/ready'), client.post('/api/best5', json={})):
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.get_json()['status'], "loading")
+                self.assertEqual(response.headers['Retry-After'], str(routes.RETRY_AFTER))
+
+            # Any failure of the loader is reported, without asking the clients to retry
+            with mock.patch('app.load_dataset', side_effect=KeyError('columns')):
+                initialize()
+            self.assertEqual(WEB_SERVER.init_error, "KeyError: 'columns'")
+            for response in (client.get('/api/ready'), client.post('/api/best5', json={})):
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.get_json(),
+                                 {"status": "error", "reason": "KeyError: 'columns'"})
+                self.assertNotIn('Retry-After', response.headers)
+
+        # The server is ready once the parser is published
+        WEB_SERVER.data_parser = DataParser(DataIngestor("./unittests/best5/best5.csv"))
+        self.assertEqual(client.get('/api/ready').get_json(), {"status": "ready"})
+
+        print("Test readiness passed successfully.")
+
 def main():
     """Run the unit tests."""
     unittest.main()